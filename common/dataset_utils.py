@@ -1,8 +1,12 @@
 import numpy as np
+import scipy.sparse
 import os
 
 from common import thousand_genomes
 
+# Number of cross-validation folds of the 1000 genomes dataset
+NB_FOLDS = 5
+
 def shuffle(data_sources, seed=23):
     '''
     Shuffles multiple data sources (numpy arrays) together so the
@@ -58,39 +62,179 @@ def prune_splits(splits, nb_prune):
         normalization_constant = 1.0 / sum(splits)
     return [s * normalization_constant for s in splits[:-nb_prune]]
 
-def load_1000_genomes(transpose=False, label_splits=None, feature_splits=None, nolabels='raw', fold=0, norm=True, path=''):
+class FoldView(object):
+    """
+    Rows of a base genotype matrix selected by an index array, without copying
+    them. Rows are gathered from the base matrix only when indexed.
+
+    Parameters
+    ----------
+    base : array (possibly memory-mapped) of shape (nb_subjects, nb_features)
+    indices : int array
+        Rows of base that belong to this view, in order.
+    """
+    def __init__(self, base, indices):
+        self.base = base
+        self.indices = indices
+
+    @property
+    def shape(self):
+        return (len(self.indices),) + self.base.shape[1:]
+
+    @property
+    def dtype(self):
+        return self.base.dtype
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            # Select the columns first so that only the selected block of
+            # the rows is gathered
+            return self.base[(slice(None),) + key[1:]][self.indices[key[0]]]
+        return self.base[self.indices[key]]
+
+    def take(self, indices, axis=0, out=None, mode='raise'):
+        assert axis == 0
+        return np.take(self.base, self.indices[indices], axis=0, out=out,
+                       mode=mode)
+
+    def __array__(self, dtype=None, copy=None):
+        rows = self.base[self.indices]
+        return rows if dtype is None else rows.astype(dtype)
+
+def load_folds(nb_elements, path='', nb_folds=NB_FOLDS, seed=23):
+    '''
+    Returns the rows of each of the nb_folds cross-validation folds.
+
+    The permutation is the one of shuffle(..., seed) and the folds are the
+    ones split(..., [.2, .2, .2, .2]) gives. They are saved in path the first
+    time and loaded from there afterwards.
+    '''
+    filename = os.path.join(path, 'folds%d_seed%d.npz' % (nb_folds, seed))
+
+    # A single attempt at loading, since other jobs may be writing the file
+    try:
+        with np.load(filename) as f:
+            permutation = f['permutation']
+            boundaries = f['boundaries']
+    except (IOError, OSError):
+        permutation = None
+
+    if permutation is None or len(permutation) != nb_elements:
+        permutation = np.arange(nb_elements)
+        np.random.RandomState(seed).shuffle(permutation)
+        fold_size = int(nb_elements * (1. / nb_folds))
+        boundaries = np.array([i * fold_size for i in range(nb_folds)] +
+                              [nb_elements])
+        tmp_filename = filename + '.tmp%d.npz' % os.getpid()
+        np.savez(tmp_filename, permutation=permutation, boundaries=boundaries)
+        os.replace(tmp_filename, filename)
+
+    return [permutation[boundaries[i]:boundaries[i + 1]]
+            for i in range(nb_folds)]
+
+def get_fold_indices(nb_elements, fold, label_splits, path='', seed=23):
+    '''
+    Returns the train, valid and test rows of the given fold. The test set is
+    the fold itself and the remaining folds are split according to
+    label_splits into the train and valid sets.
+    '''
+    all_folds = load_folds(nb_elements, path, seed=seed)
+    test_idx = all_folds[fold]
+    rest_idx = np.concatenate(all_folds[:fold] + all_folds[(fold + 1):])
+    train_idx, valid_idx = split([rest_idx], label_splits)
+    return train_idx[0], valid_idx[0], test_idx
+
+def compute_stats(x, block_size=256):
+    '''
+    Computes the per feature mean and standard deviation of an int8 genotype
+    matrix, by blocks of rows so that no float copy of the whole matrix is
+    made. Missing calls are counted as 0, like in load_1000_genomes.
+
+    Returns (mu, sigma) as float32 vectors.
+    '''
+    sums = np.zeros(x.shape[1], dtype='float64')
+    sq_sums = np.zeros(x.shape[1], dtype='float64')
+    for start in range(0, x.shape[0], block_size):
+        block = to_float(x[start:start + block_size], dtype='float64')
+        sums += block.sum(axis=0)
+        sq_sums += (block ** 2).sum(axis=0)
+
+    mu = sums / x.shape[0]
+    sigma = np.sqrt(np.maximum(sq_sums / x.shape[0] - mu ** 2, 0))
+
+    return mu.astype('float32'), sigma.astype('float32')
+
+def to_float(x, dtype='float32', out=None):
+    '''
+    Returns a float copy of (a batch of) int8 genotypes where missing calls are
+    counted as 0, i.e. as homozygous for the major allele. If out is given, the
+    copy is written in it.
+    '''
+    if out is None:
+        out = np.array(x, dtype=dtype)
+    else:
+        out[...] = x
+    # MISSING_GENOTYPE is the only negative code
+    np.maximum(out, 0, out=out)
+    return out
+
+def standardize(x, stats, out=None):
+    '''
+    Standardizes a (batch of) int8 genotypes with the (mu, sigma) returned by
+    compute_stats. Missing calls are counted as 0. If out is given, the result
+    is written in it.
+    '''
+    mu, sigma = stats
+    x = to_float(x, out=out)
+    x -= mu[None, :]
+    x /= sigma[None, :]
+    return x
+
+def load_1000_genomes(transpose=False, label_splits=None, feature_splits=None, nolabels='raw', fold=0, norm=True, path='',
+                      lazy_norm=False):
+    '''
+    With lazy_norm, the genotypes of the train, valid and test sets are
+    returned as int8 FoldViews of the memory-mapped dataset and the
+    (mu, sigma) vectors needed to standardize them (see standardize) are
+    appended to the returned values.
+    '''
+
+    assert not (lazy_norm and transpose)
 
     if nolabels == 'raw' or not transpose:
         # Load raw data either for supervised or unsupervised part
         x, y = thousand_genomes.load_data(path)
-        x = x.astype('float32')
-
-        (x, y) = shuffle((x, y))  # seed is fixed, shuffle is always the same
 
         # Prepare training and validation sets
         assert len(label_splits) == 1  # train/valid split
         # 5-fold cross validation: this means that test will always be 20%
-        all_folds = split([x, y], [.2, .2, .2, .2])
         assert fold >= 0
-        assert fold < 5
+        assert fold < NB_FOLDS
+        train_idx, valid_idx, test_idx = get_fold_indices(
+            x.shape[0], fold, label_splits, path)
+        # Keep the minibatch shuffling of the training scripts reproducible
+        np.random.seed(23)
 
-        # Separate choosen test set
-        test = all_folds[fold]
-        all_folds = all_folds[:fold] + all_folds[(fold + 1):]
-
-        x = np.concatenate([el[0] for el in all_folds])
-        y = np.concatenate([el[1] for el in all_folds])
+        # Training and validation sets together (used for the normalization
+        # statistics and the unsupervised data)
+        x_train_valid = FoldView(x, np.concatenate([train_idx, valid_idx]))
 
     # Data used for supervised training
     if not transpose:
-        train, valid = split([x, y], label_splits)
-        if norm:
-            mu = x.mean(axis=0)
-            sigma = x.std(axis=0)
-            train[0] = (train[0] - mu[None, :]) / sigma[None, :]
-            valid[0] = (valid[0] - mu[None, :]) / sigma[None, :]
-            test[0] = (test[0] - mu[None, :]) / sigma[None, :]
-        rvals = [train, valid, test]
+        if lazy_norm:
+            norm_stats = compute_stats(x_train_valid)
+            rvals = [[FoldView(x, idx), y[idx]]
+                     for idx in [train_idx, valid_idx, test_idx]]
+        elif norm:
+            stats = compute_stats(x_train_valid)
+            rvals = [[standardize(FoldView(x, idx), stats), y[idx]]
+                     for idx in [train_idx, valid_idx, test_idx]]
+        else:
+            rvals = [[to_float(FoldView(x, idx)), y[idx]]
+                     for idx in [train_idx, valid_idx, test_idx]]
     else:
         rvals = []
 
@@ -98,13 +242,17 @@ def load_1000_genomes(transpose=False, label_splits=None, feature_splits=None, n
     if nolabels == 'raw' and not transpose:
         unsupervised_data = None  # x.transpose()
     elif nolabels == 'raw' and transpose:
-        unsupervised_data = x.transpose()
+        unsupervised_data = to_float(x_train_valid).transpose()
     elif nolabels == 'histo3':
         unsupervised_data = np.load(os.path.join(path, 'histo3_fold%d.npy' % fold))
     elif nolabels == 'histo3x26':
         unsupervised_data = np.load(os.path.join(path, 'histo3x26_fold%d.npy' % fold))
+    elif nolabels == 'bag_of_genes':
+        unsupervised_data = scipy.sparse.load_npz(os.path.join(path, 'bag_of_genes_fold%d.npz' % fold))
     elif nolabels == 'bin':
-        unsupervised_data = np.load(os.path.join(path, 'snp_bin_fold%d.npy' % fold))
+        # Bit-packed rows, see utils_helpers.generate_1000_genomes_snp2bin
+        with np.load(os.path.join(path, 'snp_bin_packed_fold%d.npz' % fold)) as f:
+            unsupervised_data = f['packed']
     elif nolabels == 'w2v':
         raise NotImplementedError
     else:
@@ -120,4 +268,7 @@ def load_1000_genomes(transpose=False, label_splits=None, feature_splits=None, n
     else:
         rvals += [unsupervised_data]
 
+    if lazy_norm:
+        rvals += [norm_stats]
+
     return rvals
@@ -0,0 +1,160 @@
+import numpy as np
+
+# Code used in the genotype matrices for calls reported as NA by PLINK
+MISSING_GENOTYPE = -1
+
+# Number of subjects decoded at once by parse_raw
+RAW_BLOCK_SIZE = 64
+
+def _count_lines(filename, chunk_size=1 << 24):
+    nb_lines = 0
+    last = b'\n'
+    with open(filename, 'rb') as f:
+        chunk = f.read(chunk_size)
+        while chunk:
+            nb_lines += chunk.count(b'\n')
+            last = chunk[-1:]
+            chunk = f.read(chunk_size)
+    # Count a last line without a trailing newline
+    return nb_lines + (last != b'\n')
+
+def _raw_lookup_table():
+    # Maps the byte of each (single character) genotype token to its code
+    lut = np.full(256, -128, dtype='int8')
+    lut[ord('0')] = 0
+    lut[ord('1')] = 1
+    lut[ord('2')] = 2
+    lut[ord('9')] = MISSING_GENOTYPE  # 'NA' tokens are rewritten as '9'
+    return lut
+
+def _decode_raw_block(genotypes, nb_features, lut, out):
+    '''
+    Decodes the genotype part of a block of .raw lines into out, an int8
+    array of shape (len(genotypes), nb_features).
+
+    Once 'NA' is rewritten as a single character, every token is one byte
+    followed by one separator, so the codes are every other byte of the
+    joined block.
+    '''
+    block = b' '.join(genotypes).replace(b'NA', b'9')
+    if len(block) != 2 * nb_features * len(genotypes) - 1:
+        raise ValueError('Malformed .raw block: expected %i single-space '
+                         'separated genotypes per subject' % nb_features)
+    codes = np.frombuffer(block, dtype='uint8')[::2]
+    np.take(lut, codes.reshape(out.shape), out=out)
+    if (out == -128).any():
+        raise ValueError('Unexpected genotype value in .raw file')
+
+def parse_raw(filename, block_size=RAW_BLOCK_SIZE):
+    '''
+    Parses a PLINK .raw file (as produced by --recode A) block by block into a
+    preallocated int8 matrix. Missing calls are stored as MISSING_GENOTYPE.
+
+    Returns the list of subject ids (first column) and the genotype matrix.
+    '''
+    nb_subjects = _count_lines(filename) - 1
+    lut = _raw_lookup_table()
+
+    with open(filename, 'rb') as f:
+        nb_features = len(f.readline().split()) - 6
+        genomic_data = np.empty((nb_subjects, nb_features), dtype='int8')
+        subject_ids = []
+
+        start = 0
+        while start < nb_subjects:
+            genotypes = []
+            for line in f:
+                fields = line.split(None, 6)
+                subject_ids.append(fields[0].decode())
+                genotypes.append(fields[6].rstrip())
+                if len(genotypes) == block_size:
+                    break
+            if not genotypes:
+                break
+            end = start + len(genotypes)
+            _decode_raw_block(genotypes, nb_features, lut,
+                              genomic_data[start:end])
+            start = end
+
+    return subject_ids, genomic_data
+
+# First bytes of a SNP-major PLINK .bed file
+BED_MAGIC = b'\x6c\x1b\x01'
+
+# Number of SNPs decoded at once by read_bed
+BED_BLOCK_SIZE = 4096
+
+def read_fam(filename):
+    '''
+    Reads a PLINK .fam file. Returns the family and individual ids of the
+    subjects, in the order in which they appear in the .bed file.
+    '''
+    fids = []
+    iids = []
+    with open(filename, 'r') as f:
+        for line in f:
+            fields = line.split()
+            fids.append(fields[0])
+            iids.append(fields[1])
+    return fids, iids
+
+def read_bim(filename):
+    '''
+    Reads a PLINK .bim file. Returns the SNP ids and the two alleles of every
+    SNP. Genotypes are counted in number of copies of the first allele, like
+    in the output of --recode A.
+    '''
+    snp_ids = []
+    alleles = []
+    with open(filename, 'r') as f:
+        for line in f:
+            fields = line.split()
+            snp_ids.append(fields[1])
+            alleles.append((fields[4], fields[5]))
+    return snp_ids, alleles
+
+def _bed_lookup_table():
+    # Maps every byte of the .bed file to the genotypes of the 4 subjects it
+    # packs. The 2 bit codes are stored lowest bits first and mean
+    # 00: homozygous first allele, 01: missing, 10: heterozygous,
+    # 11: homozygous second allele.
+    codes = np.array([2, MISSING_GENOTYPE, 1, 0], dtype='int8')
+    byte_values = np.arange(256)
+    shifts = np.arange(0, 8, 2)
+    return codes[(byte_values[:, None] >> shifts[None, :]) & 3]
+
+def read_bed(filename, nb_subjects, nb_snps, block_size=BED_BLOCK_SIZE):
+    '''
+    Reads a SNP-major PLINK .bed file into an int8 matrix of shape
+    (nb_subjects, nb_snps). Missing calls are stored as MISSING_GENOTYPE.
+    '''
+    bytes_per_snp = (nb_subjects + 3) // 4
+    lut = _bed_lookup_table()
+    genomic_data = np.empty((nb_subjects, nb_snps), dtype='int8')
+
+    with open(filename, 'rb') as f:
+        if f.read(3) != BED_MAGIC:
+            raise ValueError('%s is not a SNP-major PLINK .bed file' % filename)
+
+        for start in range(0, nb_snps, block_size):
+            end = min(start + block_size, nb_snps)
+            packed = np.fromfile(f, dtype='uint8',
+                                 count=(end - start) * bytes_per_snp)
+            if packed.size != (end - start) * bytes_per_snp:
+                raise ValueError('Unexpected end of file in %s' % filename)
+            packed = packed.reshape(end - start, bytes_per_snp)
+            genotypes = lut[packed].reshape(end - start, -1)
+            genomic_data[:, start:end] = genotypes[:, :nb_subjects].T
+
+    return genomic_data
+
+def load_bfile(prefix, block_size=BED_BLOCK_SIZE):
+    '''
+    Loads the PLINK fileset prefix.bed/.bim/.fam. Returns the subject (family)
+    ids and the genotype matrix.
+    '''
+    fids, _ = read_fam(prefix + '.fam')
+    snp_ids, _ = read_bim(prefix + '.bim')
+    genomic_data = read_bed(prefix + '.bed', len(fids), len(snp_ids),
+                            block_size)
+    return fids, genomic_data
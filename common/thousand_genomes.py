@@ -1,57 +1,104 @@
 import numpy as np
 import os
+import shutil
+import tempfile
 
-def load_data(path='', force_npz_recreation=False):
-    dataset_file = 'affy_6_biallelic_snps_maf005_aut_thinned_dataset.npz'
+from common import plink
+
+# Code used in the genotype matrices for calls reported as NA by PLINK
+MISSING_GENOTYPE = plink.MISSING_GENOTYPE
+
+# Directory holding the parsed dataset (genomic.npy, label.npy)
+DATASET_STORE = 'affy_6_biallelic_snps_maf005_aut_thinned_dataset'
+
+def _load_store(store_dir, mmap_mode='r'):
+    genomic_data = np.load(os.path.join(store_dir, 'genomic.npy'),
+                           mmap_mode=mmap_mode)
+    label_data = np.load(os.path.join(store_dir, 'label.npy'))
+    return genomic_data, label_data
+
+def _save_store(store_dir, genomic_data, label_data, force_recreation=False):
+    # Write the store in a temporary directory and move it into place so that
+    # concurrent jobs never see a partially written store
+    if os.path.isdir(store_dir) and not force_recreation:
+        # Another job created the store in the meantime
+        return
+    parent_dir = os.path.dirname(store_dir) or '.'
+    tmp_dir = tempfile.mkdtemp(prefix='.tmp_', dir=parent_dir)
+    np.save(os.path.join(tmp_dir, 'genomic.npy'), genomic_data)
+    np.save(os.path.join(tmp_dir, 'label.npy'), label_data)
+    if force_recreation and os.path.isdir(store_dir):
+        # Move the old store aside before deleting it. The jobs which
+        # memory-mapped its files keep reading them.
+        old_dir = tempfile.mkdtemp(prefix='.old_', dir=parent_dir)
+        try:
+            os.rename(store_dir, os.path.join(old_dir, 'store'))
+        except OSError:
+            # Another job moved it already
+            pass
+        shutil.rmtree(old_dir, ignore_errors=True)
+    try:
+        os.rename(tmp_dir, store_dir)
+    except OSError:
+        # Another job created a complete store in the meantime
+        shutil.rmtree(tmp_dir)
+
+def load_data(path='', force_recreation=False, mmap_mode='r'):
+    '''
+    Returns the int8 genotype matrix and the one-hot labels of the dataset.
+
+    The genotypes are stored uncompressed in an .npy file and, by default,
+    opened as a read-only memory map, so loading is immediate and the pages
+    are shared between the processes reading the same store.
+    '''
+    bfile_prefix = 'affy_6_biallelic_snps_maf005_aut_thinned'
     genome_file = 'affy_6_biallelic_snps_maf005_aut_thinned_A.raw'
     label_file = '../data/affy_samples.20141118.panel'
-    
-    if os.path.exists(os.path.join(path, dataset_file)) and not force_npz_recreation:
-        genomic_data, label_data = np.load(os.path.join(path, dataset_file)).values()
-        return genomic_data, label_data
-        
-    print('No binary .npz file has been found for this dataset. The data will '
-          'be parsed to produce one. This will take a few minutes.')
-    
-    # Load the genomic data file
-    with open(os.path.join(path, genome_file), 'r') as f:
-        lines = f.readlines()[1:]
-    headers = [l.split()[:6] for l in lines]
-    
-    nb_features = len(lines[-1].split()[6:])
-    genomic_data = np.empty((len(lines), nb_features), dtype='int8')
-    for idx, line in enumerate(lines):
-        if idx % 100 == 0:
-            print('Parsing subject %i out of %i' % (idx, len(lines)))
-        genomic_data[idx] = [int(e) for e in line.replace('NA', '0').split()[6:]]
-    
+    store_dir = os.path.join(path, DATASET_STORE)
+
+    if os.path.isdir(store_dir) and not force_recreation:
+        return _load_store(store_dir, mmap_mode)
+
+    print('No genotype store has been found for this dataset. The data will '
+          'be parsed to produce one.')
+
+    # Load the genomic data, from the binary PLINK fileset if available and
+    # from the --recode A text file otherwise
+    if os.path.exists(os.path.join(path, bfile_prefix + '.bed')):
+        subject_ids, genomic_data = plink.load_bfile(
+            os.path.join(path, bfile_prefix))
+    else:
+        subject_ids, genomic_data = plink.parse_raw(
+            os.path.join(path, genome_file))
+
     # Load the label file
     label_dict = {}
     with open(os.path.join(path, label_file), 'r') as f:
         for line in f.readlines()[1:]:
             patient_id, ethnicity, _ = line.split()
             label_dict[patient_id] = ethnicity
-            
+
     # Transform the label into a one-hot format
     all_labels = list(set(label_dict.values()))
     all_labels.sort()
-    
+
     label_data = np.zeros((genomic_data.shape[0], len(all_labels)), dtype='float32')
 
-    for subject_idx in range(len(headers)):
-        subject_id = headers[subject_idx][0]
+    for subject_idx, subject_id in enumerate(subject_ids):
         subject_label = label_dict[subject_id]
         label_idx = all_labels.index(subject_label)
         label_data[subject_idx, label_idx] = 1.0
 
     # Save the parsed data to the filesystem
     print('Saving parsed data to a binary format for faster loading in the future.')
-    np.savez(os.path.join(path, dataset_file), genomic=genomic_data, label=label_data)
+    _save_store(store_dir, genomic_data, label_data, force_recreation)
 
-    return genomic_data, label_data
+    # Return the store as it is loaded from now on (memory-mapped), whether
+    # it was written by this job or by a concurrent one
+    return _load_store(store_dir, mmap_mode)
 
 if __name__ == '__main__':
-    x = load_data(force_npz_recreation=True)
+    x = load_data(force_recreation=True)
     print('Load1 done')
     x = load_data()
     print('Load2 done')
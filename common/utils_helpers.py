@@ -1,7 +1,45 @@
 import numpy as np
-import sys
+import scipy.sparse
+import argparse
+import multiprocessing
 import os
-from common import dataset_utils
+from common import dataset_utils, thousand_genomes
+
+def _pool_map(func, tasks, jobs=1):
+    # Runs func over tasks in a pool of jobs processes. The workers open the
+    # memory-mapped genotype store themselves, so only small arguments and
+    # results are pickled.
+    if jobs <= 1:
+        return [func(t) for t in tasks]
+    pool = multiprocessing.Pool(jobs)
+    try:
+        return pool.map(func, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def compute_genotype_counts(x, labels, nb_classes, block_size=4096):
+    '''
+    Counts, for every SNP (column of x), the subjects of each class having 0, 1
+    and 2 copies of the minor allele. Missing calls are counted as 0 copies.
+
+    The counts of a block of SNPs are obtained for all classes at once as the
+    product of a class indicator matrix with the one-hot encoded genotypes.
+
+    Returns an array of shape (nb_snps, nb_classes, 3).
+    '''
+    class_indicator = np.zeros((nb_classes, x.shape[0]), dtype='float32')
+    class_indicator[labels, np.arange(x.shape[0])] = 1
+
+    counts = np.empty((x.shape[1], nb_classes, 3), dtype='float32')
+    for start in range(0, x.shape[1], block_size):
+        block = x[:, start:start + block_size]
+        one_hot = [block <= 0, block == 1, block == 2]
+        for genotype in range(3):
+            counts[start:start + block_size, :, genotype] = \
+                np.dot(class_indicator, one_hot[genotype].astype('float32')).T
+
+    return counts
 
 def generate_1000_genomes_hist(transpose=False, label_splits=None, feature_splits=None, fold=0, perclass=False, path=''):
     '''
@@ -13,86 +51,154 @@ def generate_1000_genomes_hist(transpose=False, label_splits=None, feature_split
                                                  fold=fold,
                                                  norm=False, path=path)
 
-    # Generate no_label: fuse train and valid sets
-    nolabel_orig = (np.vstack([train[0], valid[0]])).transpose()
-    nolabel_y = np.vstack([train[1], valid[1]])
-
-    nolabel_y = nolabel_y.argmax(axis=1)
-
     filename = ('histo3x26' if perclass else 'histo3') + '_fold%d.npy' % fold
 
-    if perclass:
-        # the first dimension of the following is length 'number of snps'
-        nolabel_x = np.zeros((nolabel_orig.shape[0], 3*26))
-        for i in range(nolabel_x.shape[0]):
-            if i % 5000 == 0:
-                print('processing snp no: ', i)
-            for j in range(26):
-                nolabel_x[i, j*3:j*3+3] += \
-                    np.bincount(nolabel_orig[i, nolabel_y == j ].astype('int32'), minlength=3)
-                nolabel_x[i, j*3:j*3+3] /= \
-                    nolabel_x[i, j*3:j*3+3].sum()
-            # print nolabel_orig[0,:].shape
-            # print nolabel_orig[0,:].sum()
-            # print nolabel_y
-            # print zip(np.sum(nolabel_x[0,:].reshape(26,3), axis=1), np.bincount(nolabel_y.astype('int32')))
-            # print nolabel_x[0,:].reshape(26,3)
-    else:
-        nolabel_x = np.zeros((nolabel_orig.shape[0], 3))
-        for i in range(nolabel_x.shape[0]):
-            nolabel_x[i, :] += np.bincount(nolabel_orig[i, :].astype('int32'), minlength=3)
-            nolabel_x[i, :] /= nolabel_x[i, :].sum()
-
-    nolabel_x = nolabel_x.astype('float32')
+    # Genotype counts of the no_label data: train and valid sets together
+    nb_classes = train[1].shape[1] if perclass else 1
+    counts = 0
+    for x, y in [train, valid]:
+        labels = y.argmax(axis=1) if perclass else np.zeros(len(y), dtype='int32')
+        counts = counts + compute_genotype_counts(x, labels, nb_classes)
+
+    # the first dimension of the following is length 'number of snps'
+    nolabel_x = counts / counts.sum(axis=2, keepdims=True)
+    nolabel_x = nolabel_x.reshape(counts.shape[0], -1).astype('float32')
 
     np.save(os.path.join(path, filename), nolabel_x)
 
-def generate_1000_genomes_bag_of_genes(transpose=False, label_splits=None, feature_splits=[0.8], fold=0, path=''):
+def _count_snp_block(task):
+    path, start, end, fold_labels, nb_labels = task
+    x, _ = thousand_genomes.load_data(path)
+    return compute_genotype_counts(x[:, start:end], fold_labels, nb_labels)
 
-    train, valid, test, _ = dataset_utils.load_1000_genomes(transpose=transpose, label_splits=label_splits,
-                                                 feature_splits=feature_splits, fold=fold,
-                                                 norm=False)
+def generate_1000_genomes_hist_all_folds(perclass=False, path='', jobs=1,
+                                         block_size=16384):
+    '''
+    Generates the histogram embeddings of all the cross-validation folds from
+    a single load of the data and a single pass over it.
 
-    nolabel_orig = (np.vstack([train[0], valid[0]]))
+    The genotype counts are computed per (fold, class) at once, by blocks of
+    SNPs spread over jobs processes. The counts of the no_label data of a fold
+    (train and valid sets) are then the total counts minus the counts of its
+    test fold.
+    '''
+    x, y = thousand_genomes.load_data(path)
+    # The folds used for training (see dataset_utils.get_fold_indices)
+    nb_folds = dataset_utils.NB_FOLDS
+    all_folds = dataset_utils.load_folds(x.shape[0], path, nb_folds)
+
+    nb_classes = y.shape[1] if perclass else 1
+    labels = y.argmax(axis=1) if perclass else np.zeros(len(y), dtype='int32')
+    fold_labels = np.empty(x.shape[0], dtype='int32')
+    for fold, idx in enumerate(all_folds):
+        fold_labels[idx] = fold * nb_classes + labels[idx]
+
+    tasks = [(path, start, min(start + block_size, x.shape[1]), fold_labels,
+              nb_folds * nb_classes)
+             for start in range(0, x.shape[1], block_size)]
+    counts = np.concatenate(_pool_map(_count_snp_block, tasks, jobs))
+    counts = counts.reshape(x.shape[1], nb_folds, nb_classes, 3)
+    total_counts = counts.sum(axis=1)
+
+    for fold in range(nb_folds):
+        filename = ('histo3x26' if perclass else 'histo3') + '_fold%d.npy' % fold
+        nolabel_counts = total_counts - counts[:, fold]
+        nolabel_x = nolabel_counts / nolabel_counts.sum(axis=2, keepdims=True)
+        nolabel_x = nolabel_x.reshape(x.shape[1], -1).astype('float32')
+        np.save(os.path.join(path, filename), nolabel_x)
+
+def generate_1000_genomes_bag_of_genes(transpose=False, label_splits=None, feature_splits=[0.8], fold=0, path='',
+                                       block_size=16384):
+    '''
+    Generates the bag of genes embedding of the no_label data (train and valid
+    sets) of a fold, as a scipy.sparse CSR matrix with one row per SNP. For
+    subject s, column 2*s+1 is set if the subject has at least one copy of the
+    minor allele and column 2*s if it has two.
+    '''
+    x, _ = thousand_genomes.load_data(path)
+    train_idx, valid_idx, _ = dataset_utils.get_fold_indices(
+        x.shape[0], fold, label_splits, path)
+    nolabel_orig = dataset_utils.FoldView(x, np.concatenate([train_idx, valid_idx]))
+    nb_subjects, nb_snps = nolabel_orig.shape
 
     if not os.path.isdir(path):
         os.makedirs(path)
 
-    filename = 'unsupervised_bag_of_genes'
-    filename += '_fold' + str(fold) + '.npy'
-
-    nolabel_x = np.zeros((nolabel_orig.shape[0], nolabel_orig.shape[1]*2))
-
-    mod1 = np.zeros(nolabel_orig.shape)
-    mod2 = np.zeros(nolabel_orig.shape)
-
-    for i in range(nolabel_x.shape[0]):
-        mod1[i, :] = np.where(nolabel_orig[i, :] > 0)[0]*2 + 1
-        mod2[i, :] = np.where(nolabel_orig == 2)[0]*2
-
-    nolabel_x[mod1] += 1
-    nolabel_x[mod2] += 1
-
-def generate_1000_genomes_snp2bin(transpose=False, label_splits=None, feature_splits=None, fold=0, path=''):
-
-    train, valid, test, _ = dataset_utils.load_1000_genomes(transpose=transpose, label_splits=label_splits,
-                                                     feature_splits=feature_splits, fold=fold, norm=False)
+    filename = 'bag_of_genes_fold' + str(fold) + '.npz'
+
+    # Build the CSR matrix by blocks of SNPs
+    blocks = []
+    for start in range(0, nb_snps, block_size):
+        block = nolabel_orig[:, start:start + block_size].T
+        snps1, subjects1 = np.nonzero(block >= 1)
+        snps2, subjects2 = np.nonzero(block == 2)
+        rows = np.concatenate([snps1, snps2])
+        cols = np.concatenate([subjects1 * 2 + 1, subjects2 * 2])
+        blocks.append(scipy.sparse.csr_matrix(
+            (np.ones(len(rows), dtype='uint8'), (rows, cols)),
+            shape=(block.shape[0], 2 * nb_subjects)))
+    nolabel_x = scipy.sparse.vstack(blocks, format='csr')
+
+    scipy.sparse.save_npz(os.path.join(path, filename), nolabel_x)
+
+def generate_1000_genomes_snp2bin(transpose=False, label_splits=None, feature_splits=None, fold=0, path='',
+                                  block_size=256):
+    '''
+    Generates the snp2bin encoding of the no_label data (train and valid sets)
+    of a fold: for SNP i, column 2*i is set if the subject has two copies of
+    the minor allele and column 2*i+1 if it has at least one. The rows are
+    stored bit-packed with np.packbits, along with the number of columns.
+    '''
+    x, _ = thousand_genomes.load_data(path)
+    train_idx, valid_idx, _ = dataset_utils.get_fold_indices(
+        x.shape[0], fold, label_splits, path)
 
     # Generate no_label: fuse train and valid sets
-    nolabel_orig = (np.vstack([train[0], valid[0]]))
-    nolabel_x = np.zeros((nolabel_orig.shape[0], nolabel_orig.shape[1]*2), dtype='uint8')
-    filename = 'unsupervised_snp_bin_fold' + str(fold) + '.npy'
-
-    # SNP to bin
-    nolabel_x[:, ::2] += (nolabel_orig == 2)
-    nolabel_x[:, 1::2] += (nolabel_orig >= 1)
-
-    np.save(os.path.join(path, filename), nolabel_x)
+    nolabel_orig = dataset_utils.FoldView(x, np.concatenate([train_idx, valid_idx]))
+    nb_bits = nolabel_orig.shape[1] * 2
+    nolabel_x = np.empty((nolabel_orig.shape[0], (nb_bits + 7) // 8), dtype='uint8')
+    filename = 'snp_bin_packed_fold' + str(fold) + '.npz'
+
+    # SNP to bin, by blocks of subjects
+    for start in range(0, nolabel_orig.shape[0], block_size):
+        block = nolabel_orig[start:start + block_size]
+        block_bin = np.empty((block.shape[0], nb_bits), dtype='uint8')
+        block_bin[:, ::2] = (block == 2)
+        block_bin[:, 1::2] = (block >= 1)
+        nolabel_x[start:start + block_size] = np.packbits(block_bin, axis=1)
+
+    np.savez(os.path.join(path, filename), packed=nolabel_x, nb_bits=nb_bits)
+
+def _generate_fold_embedding(task):
+    embedding, fold, path = task
+    print('Generating %s for fold %d' % (embedding, fold))
+    if embedding == 'snp2bin':
+        generate_1000_genomes_snp2bin(label_splits=[.75], fold=fold, path=path)
+    elif embedding == 'bag_of_genes':
+        generate_1000_genomes_bag_of_genes(label_splits=[.75], fold=fold, path=path)
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate the pre-computed embeddings')
+    parser.add_argument('path', help='Path to dataset')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--embeddings', nargs='+', default=['histo3x26'],
+                        choices=['histo3x26', 'histo3', 'snp2bin', 'bag_of_genes'],
+                        help='Embeddings to generate')
+    args = parser.parse_args()
+
+    # Create the genotype store once, before the workers open it
+    thousand_genomes.load_data(args.path)
+
+    for embedding in ['histo3x26', 'histo3']:
+        if embedding in args.embeddings:
+            generate_1000_genomes_hist_all_folds(perclass=(embedding == 'histo3x26'),
+                                                 path=args.path, jobs=args.jobs)
+
+    tasks = [(embedding, fold, args.path)
+             for embedding in ['snp2bin', 'bag_of_genes']
+             if embedding in args.embeddings
+             for fold in range(dataset_utils.NB_FOLDS)]
+    _pool_map(_generate_fold_embedding, tasks, args.jobs)
 
 if __name__ == '__main__':
-    nfold = 5
-    path = sys.argv[1]
-
-    for fold in range(nfold):
-        print('Fold number is %d/%d' % (fold, nfold))
-        generate_1000_genomes_hist(transpose=False, label_splits=[.75], feature_splits=[1.], fold=fold, perclass=True, path=path)
+    main()
@@ -0,0 +1,39 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# The variant2 scripts import their sibling modules directly
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'variant2')]
+
+from common import thousand_genomes
+
+
+def random_genotypes(nb_subjects, nb_snps, seed=0):
+    '''
+    Returns an int8 genotype matrix with about 10% of missing calls.
+    '''
+    rng = np.random.RandomState(seed)
+    x = rng.randint(0, 3, size=(nb_subjects, nb_snps)).astype('int8')
+    x[rng.rand(nb_subjects, nb_snps) < .1] = thousand_genomes.MISSING_GENOTYPE
+    return x
+
+
+@pytest.fixture
+def store(tmp_path):
+    '''
+    Synthetic genotype store, as written by thousand_genomes.load_data.
+    Returns its path, genotypes and one-hot labels.
+    '''
+    nb_subjects, nb_snps, nb_classes = 60, 37, 3
+    x = random_genotypes(nb_subjects, nb_snps)
+    y = np.zeros((nb_subjects, nb_classes), dtype='float32')
+    y[np.arange(nb_subjects), np.arange(nb_subjects) % nb_classes] = 1
+
+    store_dir = tmp_path / thousand_genomes.DATASET_STORE
+    store_dir.mkdir()
+    np.save(str(store_dir / 'genomic.npy'), x)
+    np.save(str(store_dir / 'label.npy'), y)
+    return str(tmp_path), x, y
@@ -0,0 +1,65 @@
+import os
+
+import numpy as np
+import pytest
+
+import checkpoint
+
+
+def test_checkpoint_writer(tmp_path):
+    filename = str(tmp_path / 'params.npz')
+    writer = checkpoint.CheckpointWriter()
+    values = [np.arange(10) * i for i in range(5)]
+    for i, value in enumerate(values):
+        writer.save(filename, value, epoch=i)
+    writer.save(str(tmp_path / 'other.npz'), values[0])
+    writer.flush()
+
+    # The latest version of each file, and no temporary file
+    with np.load(filename) as f:
+        np.testing.assert_array_equal(f['arr_0'], values[-1])
+        assert f['epoch'] == 4
+    assert sorted(os.listdir(str(tmp_path))) == ['other.npz', 'params.npz']
+    writer.close()
+
+
+def test_checkpoint_writer_error(tmp_path):
+    writer = checkpoint.CheckpointWriter()
+    writer.save(str(tmp_path / 'missing' / 'params.npz'), np.arange(3))
+    with pytest.raises(OSError):
+        writer.flush()
+    # The error is only raised once
+    writer.save(str(tmp_path / 'params.npz'), np.arange(3))
+    writer.close()
+    assert os.listdir(str(tmp_path)) == ['params.npz']
+
+
+def test_column_name():
+    assert checkpoint.column_name('loss. sup.') == 'loss_sup'
+    assert checkpoint.column_name('feat. W_enc var') == 'feat_W_enc_var'
+
+
+def test_metrics_log(tmp_path):
+    filename = str(tmp_path / 'errors_supervised.csv')
+    columns = ['train_total_loss', 'valid_total_loss']
+    log = checkpoint.MetricsLog(filename, columns)
+    for epoch in range(1, 6):
+        log.append(epoch, [1. / epoch, np.nan if epoch % 2 else 2. / epoch])
+    log.close()
+
+    # Resumed after epoch 3: the lines of the following epochs are removed
+    log = checkpoint.MetricsLog(filename, columns, start_epoch=3)
+    log.append(4, [.5, .25])
+    log.close()
+
+    errors = np.genfromtxt(filename, delimiter=',', names=True, ndmin=1)
+    np.testing.assert_array_equal(errors['epoch'], [1, 2, 3, 4])
+    np.testing.assert_array_equal(errors['train_total_loss'],
+                                  [1., .5, 1. / 3, .5])
+    np.testing.assert_array_equal(errors['valid_total_loss'],
+                                  [np.nan, 1., np.nan, .25])
+
+    # A new job replaces the log
+    checkpoint.MetricsLog(filename, columns).close()
+    with open(filename) as f:
+        assert f.read() == 'epoch,train_total_loss,valid_total_loss\n'
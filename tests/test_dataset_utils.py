@@ -0,0 +1,114 @@
+import numpy as np
+
+from common import dataset_utils
+
+from conftest import random_genotypes
+
+
+def dense_stats(x):
+    # Statistics of the genotypes loaded as floats, missing calls as 0
+    x = np.maximum(x, 0).astype('float64')
+    return x.mean(axis=0), x.std(axis=0)
+
+
+def test_compute_stats():
+    x = random_genotypes(50, 20)
+    mu, sigma = dataset_utils.compute_stats(x, block_size=7)
+    expected_mu, expected_sigma = dense_stats(x)
+    np.testing.assert_allclose(mu, expected_mu, rtol=1e-6)
+    np.testing.assert_allclose(sigma, expected_sigma, rtol=1e-5)
+
+
+def test_to_float_and_standardize():
+    x = random_genotypes(50, 20)
+    stats = dataset_utils.compute_stats(x)
+
+    out = np.empty(x.shape, dtype='float32')
+    result = dataset_utils.to_float(x, out=out)
+    assert result is out
+    np.testing.assert_array_equal(out, np.maximum(x, 0))
+
+    out = np.empty(x.shape, dtype='float32')
+    result = dataset_utils.standardize(x, stats, out=out)
+    assert result is out
+    mu, sigma = dense_stats(x)
+    np.testing.assert_allclose(out, (np.maximum(x, 0) - mu) / sigma,
+                               rtol=1e-5, atol=1e-5)
+
+
+def test_lazy_norm_matches_norm(store):
+    path, _, _ = store
+    dense = dataset_utils.load_1000_genomes(label_splits=[.75], path=path)
+    lazy = dataset_utils.load_1000_genomes(label_splits=[.75], path=path,
+                                           lazy_norm=True)
+    stats = lazy[-1]
+    for (x, y), (x_lazy, y_lazy) in zip(dense[:3], lazy[:3]):
+        assert x_lazy.dtype == np.int8
+        np.testing.assert_allclose(dataset_utils.standardize(x_lazy, stats),
+                                   x, rtol=1e-5, atol=1e-5)
+        np.testing.assert_array_equal(y_lazy, y)
+
+
+def test_fold_view():
+    x = random_genotypes(30, 10)
+    idx = np.random.RandomState(1).permutation(30)[:12]
+    view = dataset_utils.FoldView(x, idx)
+    expected = x[idx]
+
+    assert view.shape == expected.shape
+    assert len(view) == len(expected)
+    assert view.dtype == x.dtype
+    np.testing.assert_array_equal(np.asarray(view), expected)
+    np.testing.assert_array_equal(view[3], expected[3])
+    np.testing.assert_array_equal(view[2:7], expected[2:7])
+    np.testing.assert_array_equal(view[[5, 0, 5]], expected[[5, 0, 5]])
+
+    out = np.empty((3, 10), dtype='int8')
+    np.take(view, [4, 1, 11], axis=0, out=out)
+    np.testing.assert_array_equal(out, expected[[4, 1, 11]])
+
+
+def test_load_folds(tmp_path):
+    path = str(tmp_path)
+    folds = dataset_utils.load_folds(103, path)
+
+    # The folds of shuffle(...) and split(...)
+    (permutation,) = dataset_utils.shuffle([np.arange(103)])
+    expected = dataset_utils.split([permutation], [.2, .2, .2, .2])
+    assert len(folds) == dataset_utils.NB_FOLDS
+    for fold, (expected_fold,) in zip(folds, expected):
+        np.testing.assert_array_equal(fold, expected_fold)
+
+    # Loaded from the saved file
+    assert [f.name for f in tmp_path.iterdir()] == ['folds5_seed23.npz']
+    for fold, saved_fold in zip(folds, dataset_utils.load_folds(103, path)):
+        np.testing.assert_array_equal(fold, saved_fold)
+
+    # Generated again for another number of subjects
+    folds = dataset_utils.load_folds(50, path)
+    np.testing.assert_array_equal(np.sort(np.concatenate(folds)),
+                                  np.arange(50))
+
+
+def test_get_fold_indices(tmp_path):
+    path = str(tmp_path)
+    folds = dataset_utils.load_folds(103, path)
+    train_idx, valid_idx, test_idx = dataset_utils.get_fold_indices(
+        103, 2, [.75], path)
+    np.testing.assert_array_equal(test_idx, folds[2])
+    rest = np.concatenate(folds[:2] + folds[3:])
+    np.testing.assert_array_equal(np.concatenate([train_idx, valid_idx]),
+                                  rest)
+    assert len(train_idx) == int(len(rest) * .75)
+
+
+def test_fold_view_columns():
+    x = random_genotypes(30, 10)
+    idx = np.random.RandomState(1).permutation(30)[:12]
+    view = dataset_utils.FoldView(x, idx)
+    expected = x[idx]
+
+    for key in [(slice(None), slice(2, 8)), (slice(3, 9), slice(None, 4)),
+                (slice(None), 7), ([4, 0], slice(5, None)),
+                (slice(None), [1, 9, 3])]:
+        np.testing.assert_array_equal(view[key], expected[key])
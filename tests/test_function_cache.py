@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+theano = pytest.importorskip('theano')
+lasagne = pytest.importorskip('lasagne')
+
+import function_cache
+import learn_model
+
+
+def build_model(tmp_path, seed):
+    # Precomputed embedding, also reconstructed by the auxiliary networks
+    rng = np.random.RandomState(0)
+    x_unsup = rng.rand(12, 6).astype('float32')
+    embedding_source = str(tmp_path / 'histo3_fold0.npy')
+    np.save(embedding_source, x_unsup)
+
+    lasagne.random.set_rng(np.random.RandomState(seed))
+    return learn_model.build_model(
+        embedding_source, 12, 6, 3, x_unsup, [6], [5], [5], [4],
+        1., 1., 1., 'softmax', 0, .02, .02, .001, str(tmp_path), 0)
+
+
+def compile_functions(model):
+    learn_model.compile_functions(model, 1., -1., 1., 1., 1., 0.,
+                                  'softmax', 'adam')
+
+
+def test_cache_round_trip(tmp_path):
+    cache_dir = str(tmp_path / 'function_cache')
+    rng = np.random.RandomState(1)
+    x = rng.rand(8, 12).astype('float32')
+    y = np.eye(3, dtype='float32')[rng.randint(0, 3, 8)]
+
+    model = build_model(tmp_path, 0)
+    compile_functions(model)
+    model['refresh_embeddings']()
+    expected = model['val_fn'](x, y)
+    function_cache.save(cache_dir, 'key', model,
+                        data_vars=learn_model.get_data_vars(model) +
+                        model['cached_embeddings'],
+                        state_vars=model['optimizer_state'])
+    assert function_cache.load(cache_dir, 'other_key') is None
+
+    # A run with the same parameters, built without compiling
+    run_model = build_model(tmp_path, 1)
+    lasagne.layers.set_all_param_values(
+        run_model['layers'],
+        lasagne.layers.get_all_param_values(model['layers']))
+    cached_model = learn_model.restore_cached_model(
+        function_cache.load(cache_dir, 'key'), run_model, .001)
+    cached_model['refresh_embeddings']()
+
+    outputs = cached_model['val_fn'](x, y)
+    assert len(outputs) == len(expected)
+    for output, expected_output in zip(outputs, expected):
+        np.testing.assert_allclose(output, expected_output, rtol=1e-5)
+    for var in cached_model['optimizer_state']:
+        assert not np.any(var.get_value())
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+theano = pytest.importorskip('theano')
+lasagne = pytest.importorskip('lasagne')
+import theano.tensor as T
+
+import checkpoint
+import learn_model
+
+
+def build_model():
+    # Small model with dropout and an optimizer with accumulators
+    input_var = T.matrix('input')
+    target_var = T.matrix('target')
+    net = lasagne.layers.InputLayer((None, 4), input_var)
+    net = lasagne.layers.DropoutLayer(lasagne.layers.DenseLayer(net, 6), .5)
+    net = lasagne.layers.DenseLayer(
+        net, 2, nonlinearity=lasagne.nonlinearities.softmax)
+
+    lr = theano.shared(np.float32(.01), 'learning_rate')
+    params = lasagne.layers.get_all_params(net, trainable=True)
+    loss = lasagne.objectives.categorical_crossentropy(
+        lasagne.layers.get_output(net), target_var).mean()
+    updates = lasagne.updates.adam(loss, params, learning_rate=lr)
+    train_fn = theano.function([input_var, target_var], loss, updates=updates)
+
+    model = {'layers': [net], 'lr': lr,
+             'optimizer_state': [k for k in updates.keys()
+                                 if k not in params]}
+    return model, train_fn
+
+
+def train(train_fn, nb_steps):
+    # Minibatches drawn from the numpy random state
+    losses = []
+    for _ in range(nb_steps):
+        x = np.random.rand(8, 4).astype(theano.config.floatX)
+        y = np.eye(2, dtype=theano.config.floatX)[np.random.randint(0, 2, 8)]
+        losses.append(train_fn(x, y))
+    return losses
+
+
+def test_state_round_trip(tmp_path):
+    filename = str(tmp_path / 'dietnet_state.npz')
+    np.random.seed(0)
+    model, train_fn = build_model()
+    train(train_fn, 3)
+
+    writer = checkpoint.CheckpointWriter()
+    learn_model.save_state(writer, filename, model, 3, 2, .75,
+                           [[1., .5]] * 3, [[np.nan] * 2, [.9, .6], [.8, .7]],
+                           [[1.1, .4]] * 3, [1., .9, .8], .005)
+    writer.close()
+    expected_losses = train(train_fn, 5)
+
+    # Resume in a new model
+    np.random.seed(1)
+    resumed_model, resumed_train_fn = build_model()
+    state = learn_model.load_state(filename)
+    lasagne.layers.set_all_param_values(
+        resumed_model['layers'], learn_model.get_state_arrays(state, 'param'))
+    learn_model.set_state(resumed_model, state)
+    # The saved learning rate is the annealed one of the next epoch
+    assert np.isclose(resumed_model['lr'].get_value(), .005)
+    resumed_model['lr'].set_value(np.float32(.01))
+
+    np.testing.assert_allclose(train(resumed_train_fn, 5), expected_losses,
+                               rtol=1e-6)
+    assert int(state['epoch']) == 3
+    assert int(state['patience']) == 2
+    assert state['best_valid'][()] == .75
+    assert np.isclose(state['learning_rate'], .005)
+    np.testing.assert_array_equal(state['train_monitored'],
+                                  [[np.nan] * 2, [.9, .6], [.8, .7]])
+    np.testing.assert_array_equal(state['run_monitored'], [[1., .5]] * 3)
+    np.testing.assert_array_equal(state['train_loss'], [1., .9, .8])
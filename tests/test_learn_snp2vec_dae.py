@@ -0,0 +1,30 @@
+import numpy as np
+
+import learn_snp2vec_dae
+
+
+def test_packed_data_generator():
+    rng = np.random.RandomState(0)
+    dataset = rng.randint(0, 2, size=(23, 2 * 13)).astype('uint8')
+    packed = np.packbits(dataset, axis=1)
+
+    np.random.seed(1)
+    batches = [[np.array(a) for a in batch] for batch in
+               learn_snp2vec_dae.data_generator(dataset, 5, shuffle=True)]
+    np.random.seed(1)
+    packed_batches = learn_snp2vec_dae.data_generator(
+        packed, 5, shuffle=True, nb_feats=dataset.shape[1])
+
+    nb_batches = 0
+    for (inputs, targets), (packed_inputs, packed_targets) in zip(
+            batches, packed_batches):
+        np.testing.assert_array_equal(packed_targets, targets)
+        np.testing.assert_array_equal(packed_inputs, inputs)
+        nb_batches += 1
+    assert nb_batches == len(batches) == 4
+
+    # Both features of a masked SNP are set to 0
+    for inputs, targets in batches:
+        inputs = inputs.reshape(5, -1, 2)
+        masked = (inputs != targets.reshape(5, -1, 2)).any(axis=2)
+        assert np.all(inputs[masked] == 0)
@@ -0,0 +1,125 @@
+import numpy as np
+import pytest
+
+from common import dataset_utils
+import mainloop_helpers as mlh
+
+from conftest import random_genotypes
+
+
+def baseline_minibatches(inputs, targets, batchsize, indices):
+    for start in range(0, len(indices), batchsize):
+        excerpt = indices[start:start + batchsize]
+        yield inputs[excerpt], targets[excerpt]
+
+
+def copy_batches(batches):
+    # The yielded arrays are reused by later batches
+    return [[np.array(a) for a in batch] for batch in batches]
+
+
+def test_prefetch():
+    x = random_genotypes(50, 8)
+    y = np.arange(50)
+    np.random.seed(3)
+    batches = copy_batches(mlh.iterate_minibatches(x, y, 7, shuffle=True,
+                                                   nb_prefetch=3))
+    np.random.seed(3)
+    indices = np.random.permutation(50)
+    expected = list(baseline_minibatches(x, y, 7, indices))
+    assert len(batches) == len(expected)
+    for (inputs, targets), (expected_inputs, expected_targets) in zip(
+            batches, expected):
+        np.testing.assert_array_equal(inputs, expected_inputs)
+        np.testing.assert_array_equal(targets, expected_targets)
+
+
+def test_prefetch_error_and_interruption():
+    def batches():
+        yield 1
+        yield 2
+        raise ValueError('corrupted batch')
+
+    iterator = mlh.prefetch(batches(), 1)
+    assert next(iterator) == 1
+    assert next(iterator) == 2
+    with pytest.raises(ValueError):
+        next(iterator)
+
+    # The producer blocked on a full queue is stopped
+    iterator = mlh.prefetch(iter(range(100)), 2)
+    assert next(iterator) == 0
+    iterator.close()
+
+
+@pytest.mark.parametrize('nb_prefetch', [0, 2])
+def test_minibatch_buffers(nb_prefetch):
+    x = random_genotypes(40, 8)
+    y = np.eye(4, dtype='float32')[np.arange(40) % 4]
+    stats = dataset_utils.compute_stats(x)
+    view = dataset_utils.FoldView(x, np.arange(40)[::-1])
+
+    batches = copy_batches(mlh.iterate_minibatches(
+        view, y, 8, norm_stats=stats, nb_prefetch=nb_prefetch))
+    expected = list(baseline_minibatches(x[::-1], y, 8, np.arange(40)))
+    assert len(batches) == len(expected)
+    for (inputs, targets), (expected_inputs, expected_targets) in zip(
+            batches, expected):
+        assert inputs.dtype == np.float32
+        np.testing.assert_allclose(
+            inputs, dataset_utils.standardize(expected_inputs, stats))
+        np.testing.assert_array_equal(targets, expected_targets)
+
+
+def test_minibatch_buffers_reused():
+    x = random_genotypes(40, 8)
+    batches = [inputs for inputs, _ in
+               mlh.iterate_minibatches(x, np.arange(40), 8)]
+    # Two buffers are used in turn
+    assert np.shares_memory(batches[0], batches[2])
+    assert not np.shares_memory(batches[0], batches[1])
+
+
+
+@pytest.mark.parametrize('batchsize', [1, 6, 7, 23, 100])
+def test_partial_last_batch(batchsize):
+    x = random_genotypes(23, 4)
+    y = np.arange(23)
+    batches = copy_batches(mlh.iterate_minibatches(x, y, batchsize))
+    sizes = [len(targets) for _, targets in batches]
+    assert sum(sizes) == 23
+    assert all(size == min(batchsize, 23) for size in sizes[:-1])
+    np.testing.assert_array_equal(
+        np.concatenate([targets for _, targets in batches]), y)
+    np.testing.assert_array_equal(
+        np.concatenate([inputs for inputs, _ in batches]), x)
+
+    rows = [np.array(inputs) for inputs in
+            mlh.iterate_testbatches(x, batchsize)]
+    np.testing.assert_array_equal(np.concatenate(rows), x)
+    rows = [np.array(inputs) for inputs in
+            mlh.iterate_minibatches_unsup(x, batchsize)]
+    np.testing.assert_array_equal(np.concatenate(rows), x)
+
+
+def test_monitoring_partial_last_batch():
+    # The mean of the per batch values is weighted by the batch sizes
+    x = np.arange(10, dtype='float32')[:, None]
+    y = np.zeros((10, 1), dtype='float32')
+    batches = mlh.iterate_minibatches(x, y, 4)
+    values = mlh.monitoring(batches, 'test', lambda x, y: [y, x.mean()],
+                            ['mean'], prec_recall_cutoff=False)
+    np.testing.assert_allclose(values, [x.mean()])
+
+
+def test_sparse_minibatches():
+    x = random_genotypes(40, 8)
+    y = np.arange(40)
+    batches = mlh.iterate_minibatches(x, y, 16, sparse=True)
+    expected = baseline_minibatches(x, y, 16, np.arange(40))
+    for (inputs, targets), (expected_inputs, expected_targets) in zip(
+            batches, expected):
+        assert inputs.dtype == np.float32
+        np.testing.assert_array_equal(inputs.toarray(),
+                                      np.maximum(expected_inputs, 0))
+        np.testing.assert_array_equal(targets, expected_targets)
@@ -0,0 +1,152 @@
+import numpy as np
+
+import mainloop_helpers as mlh
+import metrics
+
+
+def threshold_search_cutoff(predictions, targets):
+    # Search of the breakeven point over thresholds refined down to 0.001
+    prev_threshold = 0.00
+    threshold_inc = 0.10
+    while prev_threshold <= 1.000:
+        threshold = prev_threshold + threshold_inc
+        tp = ((predictions >= threshold) * (targets == 1)).sum()
+        fp = ((predictions >= threshold) * (targets == 0)).sum()
+        fn = ((predictions < threshold) * (targets == 1)).sum()
+        precision = float(tp) / (tp + fp + 1e-20)
+        recall = float(tp) / (tp + fn + 1e-20)
+        if precision > recall:
+            if threshold_inc < 0.001:
+                return recall
+            threshold_inc /= 10
+        else:
+            prev_threshold += threshold_inc
+    return 0.0
+
+
+def random_predictions(seed, nb_samples=400, nb_classes=5):
+    rng = np.random.RandomState(seed)
+    targets = np.eye(nb_classes)[rng.randint(0, nb_classes, nb_samples)]
+    predictions = .3 * targets + .7 * rng.rand(nb_samples, nb_classes)
+    return predictions, targets
+
+
+def top_p_precision(predictions, targets):
+    # Precision and recall are equal among the P highest predictions, P being
+    # the number of positives
+    nb_positives = int(targets.sum())
+    order = np.argsort(-predictions.ravel())
+    return targets.ravel()[order[:nb_positives]].mean()
+
+
+def test_precision_recall_cutoff():
+    for seed in range(5):
+        predictions, targets = random_predictions(seed)
+        cutoff = mlh.get_precision_recall_cutoff(predictions, targets)
+        assert np.isclose(cutoff, top_p_precision(predictions, targets))
+        assert np.isclose(cutoff, threshold_search_cutoff(predictions, targets),
+                          atol=.01)
+
+
+def test_precision_recall_cutoff_ties():
+    # Tied predictions form a single threshold, whatever their order
+    predictions, targets = random_predictions(0)
+    predictions = np.round(predictions, 1)
+    cutoff = mlh.get_precision_recall_cutoff(predictions, targets)
+    order = np.random.RandomState(1).permutation(predictions.size)
+    assert cutoff == mlh.get_precision_recall_cutoff(
+        predictions.ravel()[order], targets.ravel()[order])
+
+    # Ties at the top
+    predictions = np.array([1., 1., 1., 1., .5, .5, .1, .1])
+    targets = np.array([1, 1, 1, 0, 0, 1, 0, 0])
+    assert np.isclose(mlh.get_precision_recall_cutoff(predictions, targets),
+                      .75)
+    predictions = np.array([1., 1., .8, .5, .5, .5, .1, .1])
+    targets = np.array([1, 0, 1, 1, 0, 1, 0, 0])
+    # Precision and recall are both 2/3 at the threshold .8
+    assert np.isclose(mlh.get_precision_recall_cutoff(predictions, targets),
+                      2. / 3)
+
+
+def test_breakeven_point_degenerate():
+    assert metrics.breakeven_point(np.array([0, 0]), np.array([1, 2]), 0) == 0.
+    # Precision below recall at every threshold
+    assert metrics.breakeven_point(np.array([1, 1]), np.array([2, 3]), 1) == 0.
+
+
+def test_mean_accumulator():
+    rng = np.random.RandomState(0)
+    values = rng.rand(50, 3)
+    accumulator = metrics.MeanAccumulator(3)
+    for start in range(0, 50, 16):
+        batch = values[start:start + 16]
+        accumulator.update(batch.mean(axis=0), len(batch))
+    np.testing.assert_allclose(accumulator.result(), values.mean(axis=0),
+                               rtol=1e-6)
+
+
+def test_precision_recall_histogram():
+    for seed in range(5):
+        predictions, targets = random_predictions(seed)
+        histogram = metrics.PrecisionRecallHistogram()
+        for start in range(0, len(targets), 64):
+            histogram.update(predictions[start:start + 64],
+                             targets[start:start + 64])
+        exact = mlh.get_precision_recall_cutoff(predictions, targets)
+        assert np.isclose(histogram.result(), exact, atol=1e-3)
+
+
+def printed_cutoff(output):
+    return float(output.split('precis/recall cutoff:')[1].split()[0])
+
+
+def test_monitoring_cutoff(capsys):
+    # Streamed (histogram) and exact (kept predictions) cutoffs
+    predictions, targets = random_predictions(0)
+    batches = [(predictions[start:start + 64], targets[start:start + 64])
+               for start in range(0, len(targets), 64)]
+    error_fn = lambda x, y: [x, np.mean(x.argmax(1) == y.argmax(1))]
+    streamed = mlh.monitoring(batches, 'test', error_fn, ['accuracy'])
+    streamed_cutoff = printed_cutoff(capsys.readouterr().out)
+    exact, kept_predictions, kept_targets = mlh.monitoring(
+        batches, 'test', error_fn, ['accuracy'], return_pred=True)
+    exact_cutoff = printed_cutoff(capsys.readouterr().out)
+    assert np.isclose(exact_cutoff, top_p_precision(predictions, targets),
+                      atol=1e-6)
+    assert np.isclose(streamed_cutoff, exact_cutoff, atol=1e-3)
+    np.testing.assert_allclose(
+        streamed, [np.mean(predictions.argmax(1) == targets.argmax(1))],
+        rtol=1e-6)
+    np.testing.assert_array_equal(streamed, exact)
+    np.testing.assert_array_equal(kept_predictions, predictions)
+    np.testing.assert_array_equal(kept_targets, targets)
+
+
+def test_confusion_matrices(tmp_path):
+    rng = np.random.RandomState(0)
+    predictions = rng.randint(0, 7, 300)
+    targets = rng.randint(0, 7, 300)
+    groups = [[0, 3], [1, 2, 6], [4], [5]]
+
+    cm = metrics.confusion_matrix(predictions, targets, 7)
+    expected = np.zeros((7, 7))
+    for prediction, target in zip(predictions, targets):
+        expected[prediction, target] += 1
+    np.testing.assert_array_equal(cm, expected)
+
+    lookup = metrics.group_lookup(groups, 7)
+    cm_groups = metrics.aggregate_confusion(cm, lookup, len(groups))
+    expected = np.zeros((4, 4))
+    for prediction, target in zip(predictions, targets):
+        expected[lookup[prediction], lookup[target]] += 1
+    np.testing.assert_array_equal(cm_groups, expected)
+
+    # Sums over the folds
+    filenames = []
+    for fold in range(3):
+        filenames.append(str(tmp_path / ('cm%d.npz' % fold)))
+        np.savez(filenames[-1], cm_e=cm * (fold + 1), cm_c=cm_groups)
+    cm_e, cm_c = metrics.sum_confusions(filenames)
+    np.testing.assert_array_equal(cm_e, 6 * cm)
+    np.testing.assert_array_equal(cm_c, 3 * cm_groups)
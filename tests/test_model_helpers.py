@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+import scipy.sparse
+
+theano = pytest.importorskip('theano')
+lasagne = pytest.importorskip('lasagne')
+
+import theano.sparse
+
+from common import dataset_utils
+import model_helpers as mh
+
+from conftest import random_genotypes
+
+
+def test_sparse_dense_layer():
+    floatX = theano.config.floatX
+    value = scipy.sparse.random(20, 30, density=.1, format='csr',
+                                random_state=0).astype(floatX)
+    layer = mh.SparseDenseLayer((20, 30), 5,
+                                nonlinearity=lasagne.nonlinearities.tanh)
+    output = layer.get_output_for(mh.sparse_shared(value, 'emb')).eval()
+
+    expected = np.tanh(np.dot(value.toarray(), layer.W.get_value()) +
+                       layer.b.get_value())
+    np.testing.assert_allclose(output, expected, rtol=1e-5, atol=1e-6)
+
+
+def test_standardized_sparse_dense_layer():
+    floatX = theano.config.floatX
+    x = random_genotypes(20, 30)
+    mu, sigma = dataset_utils.compute_stats(x)
+    layer = mh.StandardizedSparseDenseLayer(
+        (20, 30), theano.shared(mu.astype(floatX)),
+        theano.shared(sigma.astype(floatX)), num_units=5,
+        nonlinearity=lasagne.nonlinearities.tanh)
+
+    # Sparse batch as yielded by mainloop_helpers.iterate_minibatches
+    batch = scipy.sparse.csr_matrix(np.maximum(x, 0), dtype=floatX)
+    input_var = theano.sparse.csr_matrix('input', dtype=floatX)
+    output = theano.function([input_var],
+                             layer.get_output_for(input_var))(batch)
+
+    standardized = dataset_utils.standardize(x, (mu, sigma))
+    expected = np.tanh(np.dot(standardized, layer.W.get_value()) +
+                       layer.b.get_value())
+    np.testing.assert_allclose(output, expected, rtol=1e-4, atol=1e-5)
@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+
+from common import plink
+
+from conftest import random_genotypes
+
+
+def write_raw(filename, x, newline='\n', trailing_newline=True):
+    # PLINK --recode A output, missing calls written as NA
+    lines = [' '.join(['FID', 'IID', 'PAT', 'MAT', 'SEX', 'PHENOTYPE'] +
+                      ['rs%d_A' % j for j in range(x.shape[1])])]
+    for i, row in enumerate(x):
+        genotypes = ['NA' if g == plink.MISSING_GENOTYPE else str(g)
+                     for g in row]
+        lines.append(' '.join(['HG%05d' % i, 'HG%05d' % i, '0', '0', '1',
+                               '-9'] + genotypes))
+    content = newline.join(lines) + (newline if trailing_newline else '')
+    with open(filename, 'wb') as f:
+        f.write(content.encode())
+
+
+@pytest.mark.parametrize('newline, trailing_newline',
+                         [('\n', True), ('\r\n', True), ('\n', False),
+                          ('\r\n', False)])
+def test_parse_raw(tmp_path, newline, trailing_newline):
+    x = random_genotypes(11, 9)
+    filename = str(tmp_path / 'data.raw')
+    write_raw(filename, x, newline, trailing_newline)
+
+    # Blocks of subjects with a partial last block
+    subject_ids, genomic_data = plink.parse_raw(filename, block_size=4)
+    assert subject_ids == ['HG%05d' % i for i in range(11)]
+    assert genomic_data.dtype == np.int8
+    np.testing.assert_array_equal(genomic_data, x)
+
+
+def test_parse_raw_malformed(tmp_path):
+    filename = str(tmp_path / 'data.raw')
+    write_raw(filename, np.zeros((3, 4), dtype='int8'))
+    with open(filename) as f:
+        lines = f.readlines()
+
+    # Unexpected genotype value
+    with open(filename, 'w') as f:
+        f.writelines(lines[:3] + [lines[3][:-2] + '3\n'])
+    with pytest.raises(ValueError):
+        plink.parse_raw(filename)
+
+    # Extra genotype
+    with open(filename, 'w') as f:
+        f.writelines(lines[:3] + [lines[3][:-1] + ' 0\n'])
+    with pytest.raises(ValueError):
+        plink.parse_raw(filename)
+
+
+def write_bfile(prefix, x):
+    # SNP-major PLINK fileset, the genotypes counting the copies of the first
+    # allele of the .bim file
+    with open(prefix + '.fam', 'w') as f:
+        for i in range(x.shape[0]):
+            f.write('HG%05d HG%05d 0 0 1 -9\n' % (i, i))
+    with open(prefix + '.bim', 'w') as f:
+        for j in range(x.shape[1]):
+            f.write('1 rs%d 0 %d A G\n' % (j, 1000 + j))
+
+    codes = {2: 0, plink.MISSING_GENOTYPE: 1, 1: 2, 0: 3}
+    content = bytearray(plink.BED_MAGIC)
+    for j in range(x.shape[1]):
+        snp_bytes = bytearray((x.shape[0] + 3) // 4)
+        for i in range(x.shape[0]):
+            snp_bytes[i // 4] |= codes[x[i, j]] << (2 * (i % 4))
+        content += snp_bytes
+    with open(prefix + '.bed', 'wb') as f:
+        f.write(bytes(content))
+
+
+@pytest.mark.parametrize('nb_subjects', [7, 8])
+def test_load_bfile(tmp_path, nb_subjects):
+    x = random_genotypes(nb_subjects, 10)
+    prefix = str(tmp_path / 'data')
+    write_bfile(prefix, x)
+
+    # Blocks of SNPs with a partial last block
+    subject_ids, genomic_data = plink.load_bfile(prefix, block_size=4)
+    assert subject_ids == ['HG%05d' % i for i in range(nb_subjects)]
+    assert genomic_data.dtype == np.int8
+    np.testing.assert_array_equal(genomic_data, x)
+
+    # Same genotypes as the .raw file of the fileset
+    write_raw(prefix + '.raw', x)
+    np.testing.assert_array_equal(plink.parse_raw(prefix + '.raw')[1],
+                                  genomic_data)
+
+
+def test_read_bed_errors(tmp_path):
+    prefix = str(tmp_path / 'data')
+    write_bfile(prefix, random_genotypes(7, 10))
+    with open(prefix + '.bed', 'rb') as f:
+        content = f.read()
+
+    # Truncated file
+    with open(prefix + '.bed', 'wb') as f:
+        f.write(content[:-1])
+    with pytest.raises(ValueError):
+        plink.read_bed(prefix + '.bed', 7, 10)
+
+    # Individual-major file
+    with open(prefix + '.bed', 'wb') as f:
+        f.write(content[:2] + b'\x00' + content[3:])
+    with pytest.raises(ValueError):
+        plink.read_bed(prefix + '.bed', 7, 10)
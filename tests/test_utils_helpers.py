@@ -0,0 +1,99 @@
+import os
+
+import numpy as np
+import scipy.sparse
+
+from common import dataset_utils, utils_helpers
+
+from conftest import random_genotypes
+
+
+def loop_genotype_counts(x, labels, nb_classes):
+    # Subject by subject, missing calls counted as 0 copies
+    counts = np.zeros((x.shape[1], nb_classes, 3))
+    for subject in range(x.shape[0]):
+        for snp in range(x.shape[1]):
+            counts[snp, labels[subject], max(x[subject, snp], 0)] += 1
+    return counts
+
+
+def test_compute_genotype_counts():
+    x = random_genotypes(40, 23)
+    labels = np.random.RandomState(1).randint(0, 4, size=40)
+    counts = utils_helpers.compute_genotype_counts(x, labels, 4, block_size=5)
+    np.testing.assert_array_equal(counts, loop_genotype_counts(x, labels, 4))
+
+
+def loop_histogram(x, y, fold, perclass, path):
+    # Histogram embedding of the no_label data of a fold
+    train_idx, valid_idx, _ = dataset_utils.get_fold_indices(
+        x.shape[0], fold, [.75], path)
+    idx = np.concatenate([train_idx, valid_idx])
+    nb_classes = y.shape[1] if perclass else 1
+    labels = y[idx].argmax(axis=1) if perclass else np.zeros(len(idx), 'int')
+    counts = loop_genotype_counts(x[idx], labels, nb_classes)
+    hist = counts / counts.sum(axis=2, keepdims=True)
+    return hist.reshape(x.shape[1], -1)
+
+
+def test_generate_hist_all_folds(store):
+    path, x, y = store
+    for perclass, name in [(False, 'histo3'), (True, 'histo3x26')]:
+        utils_helpers.generate_1000_genomes_hist_all_folds(
+            perclass=perclass, path=path, block_size=10)
+        for fold in range(dataset_utils.NB_FOLDS):
+            hist = np.load(os.path.join(path, '%s_fold%d.npy' % (name, fold)))
+            assert hist.dtype == np.float32
+            np.testing.assert_allclose(
+                hist, loop_histogram(x, y, fold, perclass, path), rtol=1e-6)
+
+            # Same as the embedding of the fold alone
+            utils_helpers.generate_1000_genomes_hist(
+                label_splits=[.75], fold=fold, perclass=perclass, path=path)
+            np.testing.assert_allclose(
+                np.load(os.path.join(path, '%s_fold%d.npy' % (name, fold))),
+                hist, rtol=1e-6)
+
+
+def test_generate_bag_of_genes(store):
+    path, x, _ = store
+    utils_helpers.generate_1000_genomes_bag_of_genes(
+        label_splits=[.75], fold=1, path=path, block_size=10)
+    bag_of_genes = scipy.sparse.load_npz(
+        os.path.join(path, 'bag_of_genes_fold1.npz'))
+    assert scipy.sparse.isspmatrix_csr(bag_of_genes)
+
+    # SNP by SNP and subject by subject
+    train_idx, valid_idx, _ = dataset_utils.get_fold_indices(
+        x.shape[0], 1, [.75], path)
+    nolabel = x[np.concatenate([train_idx, valid_idx])]
+    expected = np.zeros((x.shape[1], 2 * nolabel.shape[0]))
+    for snp in range(x.shape[1]):
+        for subject in range(nolabel.shape[0]):
+            if nolabel[subject, snp] >= 1:
+                expected[snp, 2 * subject + 1] = 1
+            if nolabel[subject, snp] == 2:
+                expected[snp, 2 * subject] = 1
+    np.testing.assert_array_equal(bag_of_genes.toarray(), expected)
+
+
+def test_generate_snp2bin(store):
+    path, x, _ = store
+    utils_helpers.generate_1000_genomes_snp2bin(
+        label_splits=[.75], fold=3, path=path, block_size=7)
+    with np.load(os.path.join(path, 'snp_bin_packed_fold3.npz')) as f:
+        packed = f['packed']
+        nb_bits = int(f['nb_bits'])
+    assert nb_bits == 2 * x.shape[1]
+
+    # SNP by SNP and subject by subject
+    train_idx, valid_idx, _ = dataset_utils.get_fold_indices(
+        x.shape[0], 3, [.75], path)
+    nolabel = x[np.concatenate([train_idx, valid_idx])]
+    expected = np.zeros((nolabel.shape[0], nb_bits), dtype='uint8')
+    for subject in range(nolabel.shape[0]):
+        for snp in range(x.shape[1]):
+            expected[subject, 2 * snp] = nolabel[subject, snp] == 2
+            expected[subject, 2 * snp + 1] = nolabel[subject, snp] >= 1
+    np.testing.assert_array_equal(
+        np.unpackbits(packed, axis=1)[:, :nb_bits], expected)
@@ -0,0 +1,153 @@
+import os
+import re
+import tempfile
+import threading
+
+import numpy as np
+
+
+class CheckpointWriter(object):
+    """
+    Writes npz files from a background thread, so that saving the parameters
+    does not block training. Each file is written to a temporary file in the
+    same directory and renamed over the previous one once complete, so that an
+    interrupted write never leaves a corrupted checkpoint behind.
+
+    When a file is saved again before its previous version was written, only
+    the latest version is written.
+
+    The arrays passed to save are not copied: they must not be modified
+    afterwards (lasagne.layers.get_all_param_values already returns copies).
+    Errors raised by a write are raised again by the next call to save, flush
+    or close.
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.pending = {}
+        self.order = []
+        self.writing = False
+        self.closed = False
+        self.error = None
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def save(self, filename, *args, **kwds):
+        '''
+        Schedules np.savez(filename, *args, **kwds).
+        '''
+        args = [np.asarray(a) for a in args]
+        kwds = dict((k, np.asarray(v)) for k, v in kwds.items())
+        with self.cond:
+            self._check()
+            assert not self.closed
+            if filename not in self.pending:
+                self.order.append(filename)
+            self.pending[filename] = (args, kwds)
+            self.cond.notify_all()
+
+    def flush(self):
+        '''
+        Waits until all the scheduled files are written.
+        '''
+        with self.cond:
+            while self.order or self.writing:
+                self.cond.wait()
+            self._check()
+
+    def close(self):
+        self.flush()
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.order and not self.closed:
+                    self.cond.wait()
+                if not self.order:
+                    return
+                filename = self.order.pop(0)
+                args, kwds = self.pending.pop(filename)
+                self.writing = True
+
+            try:
+                _write(filename, args, kwds)
+            except Exception as e:
+                with self.cond:
+                    self.error = e
+            finally:
+                with self.cond:
+                    self.writing = False
+                    self.cond.notify_all()
+
+def _write(filename, args, kwds):
+    # Write next to the destination so that the rename is atomic
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename) or '.',
+                                        suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, *args, **kwds)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+
+
+def column_name(label):
+    '''
+    Returns a monitoring label as a column name of the metrics log, e.g.
+    'loss. sup.' as 'loss_sup', so that it can be read with np.genfromtxt(...,
+    names=True).
+    '''
+    return re.sub(r'\W+', '_', label).strip('_')
+
+
+class MetricsLog(object):
+    """
+    CSV file with one line of monitored values per epoch, appended and flushed
+    at the end of each epoch so that it can be read while training is running,
+    e.g. with np.genfromtxt(filename, delimiter=',', names=True).
+
+    Parameters
+    ----------
+    filename : str
+    columns : list of str
+        Names of the values of a line, after the epoch number.
+    start_epoch : int
+        Number of epochs already done when resuming a job. The lines of the
+        following epochs are removed from an existing log, which is otherwise
+        replaced.
+    """
+    def __init__(self, filename, columns, start_epoch=0):
+        header = ','.join(['epoch'] + list(columns)) + '\n'
+        lines = [header]
+        if start_epoch > 0 and os.path.exists(filename):
+            with open(filename) as f:
+                old_lines = f.readlines()
+            assert old_lines[0] == header
+            lines += [l for l in old_lines[1:]
+                      if l.endswith('\n') and
+                      int(l.split(',', 1)[0]) <= start_epoch]
+
+        self.file = open(filename, 'w')
+        self.file.writelines(lines)
+        self.file.flush()
+
+    def append(self, epoch, values):
+        self.file.write(','.join([str(epoch)] +
+                                 [repr(float(v)) for v in values]) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
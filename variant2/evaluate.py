@@ -0,0 +1,271 @@
+import numpy as np
+import argparse
+import os
+
+import mainloop_helpers as mlh
+import metrics
+
+def get_embedding_source(embedding_source, dataset_path, which_fold):
+    # Same conventions as learn_model
+    if embedding_source is None or embedding_source == 'raw':
+        raise ValueError('The models of all folds can only share a graph with '
+                         'a pre-computed embedding (e.g. histo3x26)')
+    elif embedding_source == 'bag_of_genes':
+        # The number of subjects, hence of columns, and of nonzero values of
+        # the sparse embedding differ between the folds
+        raise ValueError('The models of all folds cannot share a graph with '
+                         'the bag_of_genes embedding, whose shape depends on '
+                         'the fold')
+    elif os.path.exists(embedding_source):
+        return embedding_source, embedding_source
+    return embedding_source, os.path.join(
+        dataset_path, embedding_source + '_fold' + str(which_fold) + '.npy')
+
+def get_model_path(args, embedding_source, which_fold):
+    # Directory in which learn_model saved the model of the fold
+    beta = args.gamma if (args.gamma == 0) else args.beta
+    embedding_name = embedding_source.replace('_', '').split('.')[0]
+    exp_name = args.exp_name + embedding_name.rsplit('/', 1)[::-1][0] + '_'
+    exp_name += mlh.define_exp_name(args.keep_labels, args.alpha, beta,
+                                    args.gamma, args.lmd,
+                                    mlh.parse_int_list_arg(args.n_hidden_u),
+                                    mlh.parse_int_list_arg(args.n_hidden_t_enc),
+                                    mlh.parse_int_list_arg(args.n_hidden_t_dec),
+                                    mlh.parse_int_list_arg(args.n_hidden_s),
+                                    which_fold, args.learning_rate,
+                                    args.decoder_net_init, args.encoder_net_init,
+                                    args.early_stop_criterion,
+                                    args.learning_rate_annealing)
+    return os.path.join(args.save_path, args.dataset, exp_name)
+
+# Evaluates the best model of each fold on the test set of the fold. The graph
+# is built and compiled once: the parameters of each fold, which include its
+# feature embedding, are swapped in with set_all_param_values. With alpha or
+# beta > 0, the embedding reconstructed by the auxiliary networks is swapped in
+# as well.
+def execute(args):
+    # Deferred so that --help does not import Theano
+    import lasagne
+    from lasagne.regularization import apply_penalty, l2
+    import theano
+    import theano.tensor as T
+    import model_helpers as mh
+
+    n_hidden_u = mlh.parse_int_list_arg(args.n_hidden_u)
+    n_hidden_t_enc = mlh.parse_int_list_arg(args.n_hidden_t_enc)
+    n_hidden_t_dec = mlh.parse_int_list_arg(args.n_hidden_t_dec)
+    n_hidden_s = mlh.parse_int_list_arg(args.n_hidden_s)
+    folds = mlh.parse_int_list_arg(args.folds)
+    alpha = args.alpha
+    gamma = args.gamma
+    beta = gamma if (gamma == 0) else args.beta
+    lmd = args.lmd
+    disc_nonlinearity = args.disc_nonlinearity
+    keep_labels = args.keep_labels
+    missing_labels_val = -1
+
+    # Load the data of all folds. The genotypes stay memory-mapped and the
+    # test sets are standardized one minibatch at a time. The unnormalized
+    # embeddings are only kept if they are reconstructed.
+    print('Loading data')
+    fold_data = []
+    for fold in folds:
+        embedding_input, embedding_source = get_embedding_source(
+            args.embedding_source, args.dataset_path, fold)
+        data = mlh.load_data(args.dataset, args.dataset_path, embedding_source,
+                             which_fold=fold, embedding_input=embedding_input,
+                             lazy_norm=True)
+        x_test, y_test, norm_stats = data[4], data[5], data[8]
+        x_unsup = data[6] if (alpha > 0 or beta > 0) else None
+        fold_data.append((fold, embedding_source, x_test, y_test, norm_stats,
+                          x_unsup))
+
+    n_feats = fold_data[0][2].shape[1]
+    n_targets = fold_data[0][3].shape[1]
+    # Width of the embedding, as in learn_model
+    n_samples_unsup = np.load(fold_data[0][1], mmap_mode='r').shape[1]
+
+    # Prepare Theano variables for inputs and targets
+    input_var_sup = T.matrix('input_sup')
+    input_var_unsup = theano.shared(fold_data[0][5], 'input_unsup')
+    target_var_sup = T.matrix('target_sup')
+
+    # Build model, with the embedding of the first fold
+    print('Building model')
+    nets, embeddings, _ = mh.build_feat_emb_nets(
+        fold_data[0][1], n_feats, n_samples_unsup,
+        input_var_unsup, n_hidden_u, n_hidden_t_enc,
+        n_hidden_t_dec, gamma, args.encoder_net_init,
+        args.decoder_net_init, args.save_path)
+
+    nets += mh.build_feat_emb_reconst_nets(
+            [alpha, beta], n_samples_unsup, n_hidden_u,
+            [n_hidden_t_enc, n_hidden_t_dec],
+            nets, [args.encoder_net_init, args.decoder_net_init])
+
+    discrim_net, hidden_rep = mh.build_discrim_net(
+        None, n_feats, input_var_sup, n_hidden_t_enc,
+        n_hidden_s, embeddings[0], disc_nonlinearity, n_targets,
+        args.batchnorm)
+
+    nets += [mh.build_reconst_net(hidden_rep, embeddings[1] if
+                                  len(embeddings) > 1
+                                  else None, n_feats, gamma)]
+    all_nets = list(filter(None, nets)) + [discrim_net]
+
+    print('Building and compiling functions')
+
+    # Build functions
+    predictions, predictions_det = mh.define_predictions(nets, start=2)
+    prediction_sup, prediction_sup_det = mh.define_predictions([discrim_net])
+    prediction_sup = prediction_sup[0]
+    prediction_sup_det = prediction_sup_det[0]
+
+    _, reconst_losses_det = mh.define_reconst_losses(
+        predictions, predictions_det, [input_var_unsup, input_var_unsup,
+                                       input_var_sup])
+    _, sup_loss_det = mh.define_sup_loss(
+        disc_nonlinearity, prediction_sup, prediction_sup_det, keep_labels,
+        target_var_sup, missing_labels_val)
+
+    inputs = [input_var_sup, target_var_sup]
+
+    loss_det = sup_loss_det + alpha*reconst_losses_det[0] + \
+        beta*reconst_losses_det[1] + gamma*reconst_losses_det[2]
+
+    params = lasagne.layers.get_all_params(all_nets, trainable=True)
+    loss_det = loss_det + lmd*apply_penalty(params, l2)
+
+    # Monitoring Labels
+    monitor_labels = ['reconst. feat. W_enc',
+                      'reconst. feat. W_dec',
+                      'reconst. loss']
+    monitor_labels = [i for i, j in zip(monitor_labels, reconst_losses_det)
+                      if j != 0]
+    monitor_labels += ['feat. W_enc. mean', 'feat. W_enc var']
+    monitor_labels += ['feat. W_dec. mean', 'feat. W_dec var'] if \
+        (embeddings[1] is not None) else []
+    monitor_labels += ['loss. sup.', 'total loss']
+
+    val_outputs = [l for l in reconst_losses_det if l != 0]
+    val_outputs += [embeddings[0].mean(), embeddings[0].var()]
+    val_outputs += [embeddings[1].mean(), embeddings[1].var()] if \
+        (embeddings[1] is not None) else []
+    val_outputs += [sup_loss_det, loss_det]
+
+    test_acc, _ = mh.define_test_functions(
+        disc_nonlinearity, prediction_sup, prediction_sup_det, target_var_sup)
+    monitor_labels.append('accuracy')
+    val_outputs.append(test_acc)
+
+    # The embeddings are predicted once per fold instead of once per batch
+    cached_embeddings, refresh_embeddings = mh.cache_embeddings(embeddings)
+    replace = dict((e, c) for e, c in zip(embeddings, cached_embeddings)
+                   if e is not None)
+    val_fn = theano.function(inputs,
+                             theano.clone([prediction_sup_det] + val_outputs,
+                                          replace=replace),
+                             on_unused_input='ignore')
+
+    continent_cat = mh.create_1000_genomes_continent_labels()
+    continent_lookup = metrics.group_lookup(continent_cat, n_targets)
+
+    # Evaluate the model of each fold
+    print('Starting testing...')
+    evaluated_folds = []
+    test_monitored = []
+    cm_e_tot = 0
+    cm_c_tot = 0
+    for (fold, embedding_source, x_test, y_test, norm_stats,
+         x_unsup) in fold_data:
+        model_path = get_model_path(args, embedding_source, fold)
+        model_file = os.path.join(model_path, 'dietnet_best.npz')
+        if not os.path.exists(model_file):
+            print('No model found for fold {} in {}'.format(fold, model_path))
+            continue
+
+        with np.load(model_file) as f:
+            param_values = [f['arr_%d' % i]
+                            for i in range(len(f.files))]
+        nlayers = len(lasagne.layers.get_all_params(all_nets))
+        lasagne.layers.set_all_param_values(all_nets, param_values[:nlayers])
+        if x_unsup is not None:
+            input_var_unsup.set_value(x_unsup)
+        refresh_embeddings()
+
+        print('Fold {}'.format(fold), end=' ')
+        test_minibatches = mlh.iterate_minibatches(x_test, y_test,
+                                                   args.eval_batch_size,
+                                                   shuffle=False,
+                                                   norm_stats=norm_stats)
+        test_err, pred, targets = mlh.monitoring(test_minibatches, 'test',
+                                                 val_fn, monitor_labels,
+                                                 args.prec_recall_cutoff != 0,
+                                                 return_pred=True)
+        print('')
+
+        cm_e = metrics.confusion_matrix(pred.argmax(1), targets.argmax(1),
+                                        n_targets)
+        cm_c = metrics.aggregate_confusion(cm_e, continent_lookup,
+                                           len(continent_cat))
+        np.savez(os.path.join(model_path, 'cm' + str(fold) + '.npz'),
+                 cm_e=cm_e, cm_c=cm_c)
+
+        evaluated_folds.append(fold)
+        test_monitored.append(test_err)
+        cm_e_tot = cm_e_tot + cm_e
+        cm_c_tot = cm_c_tot + cm_c
+
+    if len(evaluated_folds) == 0:
+        return
+
+    # Summary over the folds
+    test_monitored = np.array(test_monitored)
+    for label, mean, std in zip(monitor_labels, test_monitored.mean(0),
+                                test_monitored.std(0)):
+        print('{}: {:9.6f} +- {:9.6f}'.format(label, mean, std))
+
+    summary_file = os.path.join(args.save_path, args.dataset,
+                                args.exp_name + 'test_metrics.npz')
+    np.savez(summary_file, folds=np.array(evaluated_folds),
+             labels=np.array(monitor_labels), values=test_monitored,
+             cm_e=cm_e_tot, cm_c=cm_c_tot)
+    print('Saved ' + summary_file)
+
+def main():
+    parser = argparse.ArgumentParser(description='Evaluate the Diet Networks of all folds')
+    parser.add_argument('--dataset', default='1000_genomes', help='Dataset.')
+    parser.add_argument('--n_hidden_u', default=[100], help='List of unsupervised hidden units.')
+    parser.add_argument('--n_hidden_t_enc', default=[100], help='List of theta transformation hidden units.')
+    parser.add_argument('--n_hidden_t_dec', default=[100], help='List of theta_prime transformation hidden units')
+    parser.add_argument('--n_hidden_s', default=[100], help='List of supervised hidden units.')
+    parser.add_argument('--embedding_source', default='histo3x26',
+            help='Source for the feature embedding: the name of a pre-computed embedding')
+    parser.add_argument('--learning_rate', '-lr', type=float, default=0.0001, help='Float to indicate learning rate.')
+    parser.add_argument('--learning_rate_annealing', '-lra', type=float, default=.99, help='Float to indicate learning rate annealing rate.')
+    parser.add_argument('--alpha', '-a', type=float, default=0., help='reconst_loss coeff. for auxiliary net W_enc')
+    parser.add_argument('--beta', '-b', type=float, default=0., help='reconst_loss coeff. for auxiliary net W_dec')
+    parser.add_argument('--gamma', '-g', type=float, default=10., help='reconst_loss coeff. (used for aux net W-dec as well)')
+    parser.add_argument('--lmd', '-l', type=float, default=.0, help='Weight decay coeff.')
+    parser.add_argument('--disc_nonlinearity', '-nl', default='softmax', help='''Nonlinearity to use in disc_net's last layer''')
+    parser.add_argument('--encoder_net_init', '-eni', type=float, default=0.01, help='Bounds of uniform initialization for encoder_net weights')
+    parser.add_argument('--decoder_net_init', '-dni', type=float, default=0.01, help='Bounds of uniform initialization for decoder_net weights')
+    parser.add_argument('--batchnorm', '-bn', type=int, default=0, help='Whether to use BatchNorm in the main network')
+    parser.add_argument('--keep_labels', type=float, default=1.0, help='Fraction of training labels to keep')
+    parser.add_argument('--prec_recall_cutoff', type=int, default=0, help='Whether to compute the precision-recall cutoff or not')
+    parser.add_argument('--early_stop_criterion', default='accuracy', help='Early-stopping criterion used for training')
+    parser.add_argument('--folds', default=[0, 1, 2, 3, 4], help='List of folds to evaluate')
+    parser.add_argument('--eval_batch_size', type=int, default=1024, help='Number of test subjects per minibatch')
+    parser.add_argument('--save_path', default='./', help='Path where the models were saved (--save_perm of learn_model)')
+    parser.add_argument('--dataset_path', default='./', help='Path to dataset')
+    parser.add_argument('-exp_name', type=str, default='dietnets_final_',
+            help='Experiment name that was concatenated at the beginning of the generated name')
+
+    args = parser.parse_args()
+    print('Printing args')
+    print(vars(args))
+
+    execute(args)
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,16 @@
+import time
+# Start of the imports phase of --profile_startup
+START_TIME = time.time()
+
 import numpy as np
-import matplotlib.pyplot as plt
 import argparse
 import random
-import time
 import os
 from distutils.dir_util import copy_tree
 
-import lasagne
-from lasagne.layers import DenseLayer, InputLayer, DropoutLayer, BatchNormLayer
-from lasagne.nonlinearities import sigmoid, softmax, tanh, linear, rectify, leaky_rectify, very_leaky_rectify
-from lasagne.regularization import apply_penalty, l2
-from lasagne.init import Uniform
-import theano
-import theano.tensor as T
-
 from common import dataset_utils
 import mainloop_helpers as mlh
-import model_helpers as mh
+import timing
 
 # Main program
 def execute(dataset, n_hidden_u, n_hidden_t_enc, n_hidden_t_dec, n_hidden_s,
@@ -27,7 +21,17 @@ def execute(dataset, n_hidden_u, n_hidden_t_enc, n_hidden_t_dec, n_hidden_s,
             which_set='test',
             model_path='/Tmp/romerosa/DietNetworks/newmodel/',
             save_path='/Tmp/romerosa/DietNetworks/',
-            dataset_path='/Tmp/' + os.environ["USER"] + '/datasets/'):
+            dataset_path='/Tmp/' + os.environ["USER"] + '/datasets/',
+            profile_startup=False, start_time=None):
+    timer = timing.PhaseTimer(start_time)
+
+    # Deferred so that --help does not import Theano
+    import lasagne
+    from lasagne.layers import DenseLayer
+    import theano
+    import theano.tensor as T
+    import model_helpers as mh
+    timer.lap('imports')
 
     print(save_path)
 
@@ -46,6 +50,7 @@ def execute(dataset, n_hidden_u, n_hidden_t_enc, n_hidden_t_dec, n_hidden_s,
             which_fold=which_fold, keep_labels=1.0,
             missing_labels_val=-1.0,
             embedding_input=embedding_input)
+    timer.lap('data load')
 
     if which_set == 'train':
         x = x_train
@@ -121,13 +126,14 @@ def execute(dataset, n_hidden_u, n_hidden_t_enc, n_hidden_t_dec, n_hidden_s,
 
     # Supervised network
     discrim_net, hidden_rep = mh.build_discrim_net(
-        batch_size, n_feats, input_var_sup, n_hidden_t_enc,
+        None, n_feats, input_var_sup, n_hidden_t_enc,
         n_hidden_s, embeddings[0], 'softmax', n_targets)
 
     # Reconstruct network
     nets += [mh.build_reconst_net(hidden_rep, embeddings[1] if
                                   len(embeddings) > 1
                                   else None, n_feats, gamma)]
+    timer.lap('graph build')
 
     # Load best model
     with np.load(os.path.join(model_path, 'dietnets_best.npz')) as f:
@@ -136,6 +142,7 @@ def execute(dataset, n_hidden_u, n_hidden_t_enc, n_hidden_t_dec, n_hidden_s,
     lasagne.layers.set_all_param_values(filter(None, nets) +
                                         [discrim_net],
                                         param_values)
+    timer.lap('model load')
 
     print("Building and compiling training functions")
 
@@ -145,8 +152,12 @@ def execute(dataset, n_hidden_u, n_hidden_t_enc, n_hidden_t_dec, n_hidden_s,
         predictions = lasagne.layers.get_output(feat_layers)
         inputs = []
         predict = theano.function(inputs, predictions)
+        timer.lap('compile')
         all_pred = predict()
         all_pred = all_pred
+        if profile_startup:
+            timer.lap('first batch')
+            timer.report()
 
         for i, el in enumerate(all_pred):
             file_name = os.path.join(save_path, 'layer'+str(i)+'.npy')
@@ -159,6 +170,7 @@ def execute(dataset, n_hidden_u, n_hidden_t_enc, n_hidden_t_dec, n_hidden_s,
         predictions = lasagne.layers.get_output(subject_layers)
         inputs = [input_var_sup]
         predict = theano.function(inputs, predictions)
+        timer.lap('compile')
 
         iterate_minibatches = mlh.iterate_minibatches(x, y, batch_size,
                                                       shuffle=False)
@@ -166,6 +178,9 @@ def execute(dataset, n_hidden_u, n_hidden_t_enc, n_hidden_t_dec, n_hidden_s,
         all_pred = []
         for batch in iterate_minibatches:
             all_pred += [predict(batch[0])]
+            if profile_startup and len(all_pred) == 1:
+                timer.lap('first batch')
+                timer.report()
 
         all_pred = zip(*all_pred)
         all_pred = [np.vstack(el) for el in all_pred]
@@ -271,6 +286,13 @@ def main():
     parser.add_argument('--dataset_path',
                         default='/data/lisatmp4/romerosa/datasets/1000_Genome_project/',
                         help='Path to dataset')
+    parser.add_argument('--profile_startup',
+                        type=int,
+                        default=0,
+                        help='Whether to report the time spent importing, ' +
+                             'loading the data, building the model, ' +
+                             'loading its parameters, compiling and ' +
+                             'running the first batch')
 
     args = parser.parse_args()
     print ("Printing args")
@@ -278,6 +300,8 @@ def main():
 
     folds = [0, 1, 2, 3, 4]
 
+    # The imports of the first fold start with the script
+    start_time = START_TIME
     for f in folds:
         execute(args.dataset,
                 mlh.parse_int_list_arg(args.n_hidden_u),
@@ -301,7 +325,10 @@ def main():
                 'train',
                 args.model_path,
                 args.save_path,
-                args.dataset_path)
+                args.dataset_path,
+                args.profile_startup != 0,
+                start_time)
+        start_time = None
 
 if __name__ == '__main__':
     main()
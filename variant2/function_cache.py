@@ -0,0 +1,105 @@
+import hashlib
+import os
+import pickle
+import sys
+import tempfile
+
+import lasagne
+import numpy as np
+import theano
+
+# Compiled graphs are deeply nested objects
+PICKLE_RECURSION_LIMIT = 50000
+
+def get_key(graph_args, source_files=()):
+    '''
+    Returns the key of a compiled model: a sha1 hash of the arguments that
+    shape its graph, of the Theano version and configuration, and of the
+    source files building the graph, so that any change to them invalidates
+    the cached functions.
+    '''
+    h = hashlib.sha1()
+    h.update(repr(sorted(graph_args.items())).encode('utf-8'))
+    h.update(repr((theano.__version__, theano.config.device,
+                   theano.config.floatX)).encode('utf-8'))
+    for filename in source_files:
+        with open(filename, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def _placeholder(var):
+    # Smallest value of the type of a shared variable
+    shape = [1 if b else 0 for b in var.broadcastable]
+    return np.zeros(shape, dtype=var.dtype)
+
+def save(cache_dir, key, model, data_vars=(), state_vars=()):
+    '''
+    Pickles the compiled functions of a model together with its layers and
+    shared variables (model is any picklable structure holding them), so that
+    they keep referencing the same shared variables once reloaded.
+
+    The values of data_vars and state_vars are replaced by placeholders in the
+    pickle: the state variables (e.g. the optimizer accumulators), which must
+    be all zeros, are reset to zeros by load, and the data must be set again
+    after loading. The parameter values are also saved as placeholders, whose
+    shapes differ from the ones of the parameters: they must be set with
+    set_value rather than lasagne.layers.set_all_param_values.
+    '''
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    params = lasagne.layers.get_all_params(model['layers'])
+    data_vars = [v for v in data_vars if hasattr(v, 'broadcastable')]
+    state_shapes = []
+    for v in state_vars:
+        value = v.get_value(borrow=True)
+        assert not np.any(value)
+        state_shapes.append(value.shape)
+
+    # Replace the values by placeholders while pickling
+    variables = params + data_vars + list(state_vars)
+    values = [v.get_value(borrow=True) for v in variables]
+    for v in variables:
+        v.set_value(_placeholder(v))
+
+    recursion_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(recursion_limit, PICKLE_RECURSION_LIMIT))
+    try:
+        fd, tmp_filename = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((model, list(state_vars), state_shapes), f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, os.path.join(cache_dir, key + '.pkl'))
+    finally:
+        sys.setrecursionlimit(recursion_limit)
+        for v, value in zip(variables, values):
+            v.set_value(value, borrow=True)
+
+def load(cache_dir, key):
+    '''
+    Returns the model saved by save under key, or None if there is none. The
+    state variables are reset to zeros.
+    '''
+    filename = os.path.join(cache_dir, key + '.pkl')
+    if not os.path.exists(filename):
+        return None
+
+    # The functions were optimized before being pickled
+    theano.config.reoptimize_unpickled_function = False
+
+    recursion_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(recursion_limit, PICKLE_RECURSION_LIMIT))
+    try:
+        with open(filename, 'rb') as f:
+            model, state_vars, state_shapes = pickle.load(f)
+    except Exception as e:
+        print('Could not load the compiled functions from {}: {}'.format(
+            filename, e))
+        return None
+    finally:
+        sys.setrecursionlimit(recursion_limit)
+
+    for v, shape in zip(state_vars, state_shapes):
+        v.set_value(np.zeros(shape, dtype=v.dtype))
+
+    return model
@@ -170,7 +170,7 @@ def execute(dataset, n_hidden_u, num_epochs=500,
     valid_monitored = []
     train_loss = []
 
-    nb_minibatches = n_row/batch_size
+    nb_minibatches = (n_row + batch_size - 1) // batch_size
     print("Nb of minibatches: " + str(nb_minibatches))
     start_training = time.time()
     for epoch in range(num_epochs):
@@ -1,115 +1,53 @@
+import time
+# Start of the imports phase of --profile_startup
+START_TIME = time.time()
+
 import numpy as np
 import argparse
-import time
 import os
 from distutils.dir_util import copy_tree
 
-import lasagne
-from lasagne.regularization import apply_penalty, l2
-import theano
-import theano.tensor as T
-
+import checkpoint
 import mainloop_helpers as mlh
-import model_helpers as mh
-
-# Main program
-def execute(args):
-    dataset = args.dataset
-    n_hidden_u = mlh.parse_int_list_arg(args.n_hidden_u)
-    n_hidden_t_enc = mlh.parse_int_list_arg(args.n_hidden_t_enc)
-    n_hidden_t_dec = mlh.parse_int_list_arg(args.n_hidden_t_dec)
-    n_hidden_s = mlh.parse_int_list_arg(args.n_hidden_s)
-    embedding_source = args.embedding_source
-    num_epochs = int(args.num_epochs)
-    learning_rate = args.learning_rate
-    learning_rate_annealing = args.learning_rate_annealing
-    alpha = args.alpha
-    beta = args.beta
-    gamma = args.gamma
-    lmd = args.lmd
-    disc_nonlinearity = args.disc_nonlinearity
-    encoder_net_init = args.encoder_net_init
-    decoder_net_init = args.decoder_net_init
-    optimizer = args.optimizer
-    max_patience = args.patience
-    batchnorm = args.batchnorm
-    keep_labels = args.keep_labels
-    prec_recall_cutoff = (args.prec_recall_cutoff != 0)
-    missing_labels_val = -1
-    which_fold = args.which_fold
-    early_stop_criterion = args.early_stop_criterion
-    save_path = args.save_tmp
-    save_copy = args.save_perm
-    dataset_path = args.dataset_path
-    resume = args.resume
-    exp_name = args.exp_name
-    random_proj = int(args.random_proj)
-
-    # Prepare embedding information
-    if embedding_source is None or embedding_source == 'raw':
-        embedding_source = None
-        embedding_input = 'raw'
-    elif os.path.exists(embedding_source):
-        embedding_input = embedding_source
-    else:
-        embedding_input = embedding_source
-        embedding_source = os.path.join(dataset_path, embedding_input + '_fold' + str(which_fold) + '.npy')
-
-    # Load the dataset
-    print('Loading data')
-    x_train, y_train, x_valid, y_valid, x_test, y_test, \
-        x_unsup, training_labels = mlh.load_data(
-            dataset, dataset_path, embedding_source,
-            which_fold=which_fold, keep_labels=keep_labels,
-            missing_labels_val=missing_labels_val,
-            embedding_input=embedding_input)
-
-    if x_unsup is not None:
-        n_samples_unsup = x_unsup.shape[1]
-    else:
-        n_samples_unsup = 0
-
-    # Extract required information from data
-    n_samples, n_feats = x_train.shape
-    print('Number of features : ', n_feats)
-    print('Glorot init : ', 2.0 / (n_feats + n_hidden_t_enc[-1]))
-    n_targets = y_train.shape[1]
-
-    # Set some variables
-    batch_size = 128
-    beta = gamma if (gamma == 0) else beta
+import timing
 
-    # Preparing folder to save stuff
-    if embedding_source is None:
-        embedding_name = embedding_input
-    else:
-        embedding_name = embedding_source.replace('_', '').split('.')[0]
-        exp_name += embedding_name.rsplit('/', 1)[::-1][0] + '_'
+# Lasagne, Theano and the modules depending on them are imported when they are
+# needed, so that --help and argument errors do not pay for their import
 
-    exp_name += mlh.define_exp_name(keep_labels, alpha, beta, gamma, lmd,
-                                    n_hidden_u, n_hidden_t_enc, n_hidden_t_dec,
-                                    n_hidden_s, which_fold,
-                                    learning_rate, decoder_net_init,
-                                    encoder_net_init, early_stop_criterion,
-                                    learning_rate_annealing)
+def build_model(embedding_source, n_feats, n_samples_unsup, n_targets, x_unsup,
+                n_hidden_u, n_hidden_t_enc, n_hidden_t_dec, n_hidden_s,
+                alpha, beta, gamma, disc_nonlinearity, batchnorm,
+                encoder_net_init, decoder_net_init, learning_rate, save_path,
+                random_proj, norm_stats=None, sparse_input=False):
+    '''
+    Builds the networks of the model. Returns a dict with the Theano
+    variables, the networks and the layers whose parameters are saved.
 
-    print('Experiment: ' + exp_name)
-    save_path = os.path.join(save_path, dataset, exp_name)
-    save_copy = os.path.join(save_copy, dataset, exp_name)
-    if not os.path.exists(save_path):
-        os.makedirs(save_path)
-    if not os.path.exists(save_copy):
-        os.makedirs(save_copy)
+    With sparse_input, the supervised inputs are sparse matrices of int8
+    genotypes, standardized in the graph with norm_stats.
+    '''
+    import theano
+    import theano.sparse
+    import theano.tensor as T
+    import model_helpers as mh
 
     # Prepare Theano variables for inputs and targets
-    input_var_sup = T.matrix('input_sup')
+    if sparse_input:
+        input_var_sup = theano.sparse.csr_matrix('input_sup', dtype='float32')
+        norm_stats_vars = [theano.shared(norm_stats[0], 'mu'),
+                           theano.shared(norm_stats[1], 'sigma')]
+        # The reconstruction target is the standardized dense input
+        mu, sigma = norm_stats_vars
+        reconst_target = (theano.sparse.dense_from_sparse(input_var_sup) -
+                          mu.dimshuffle('x', 0)) / sigma.dimshuffle('x', 0)
+    else:
+        input_var_sup = T.matrix('input_sup')
+        norm_stats_vars = None
+        reconst_target = input_var_sup
     input_var_unsup = theano.shared(x_unsup, 'input_unsup')  # x_unsup TBD
     target_var_sup = T.matrix('target_sup')
     lr = theano.shared(np.float32(learning_rate), 'learning_rate')
 
-    # Build model
-    print('Building model')
-
     # Some checkings
     # assert len(n_hidden_u) > 0
     assert len(n_hidden_t_enc) > 0
@@ -131,29 +69,54 @@ def execute(args):
 
     # Supervised network
     discrim_net, hidden_rep = mh.build_discrim_net(
-        batch_size, n_feats, input_var_sup, n_hidden_t_enc,
-        n_hidden_s, embeddings[0], disc_nonlinearity, n_targets, batchnorm)
+        None, n_feats, input_var_sup, n_hidden_t_enc,
+        n_hidden_s, embeddings[0], disc_nonlinearity, n_targets, batchnorm,
+        norm_stats_vars)
 
     # Reconstruct network
     nets += [mh.build_reconst_net(hidden_rep, embeddings[1] if
                                   len(embeddings) > 1
                                   else None, n_feats, gamma)]
 
-    # Load weights if we are resuming job
-    if resume:
-        # Load best model
-        with np.load(os.path.join(save_copy, 'dietnet_last.npz')) as f:
-            param_values = [f['arr_%d' % i]
-                            for i in range(len(f.files))]
-        nlayers = len(lasagne.layers.get_all_params(filter(None, nets) +
-                                                    [discrim_net]))
-        lasagne.layers.set_all_param_values(filter(None, nets) +
-                                            [discrim_net],
-                                            param_values[:nlayers])
-
-    print('Building and compiling training functions')
+    return {'input_var_sup': input_var_sup,
+            'input_var_unsup': input_var_unsup,
+            'target_var_sup': target_var_sup,
+            'reconst_target': reconst_target,
+            'norm_stats_vars': norm_stats_vars or [],
+            'lr': lr,
+            'nets': nets,
+            'embeddings': embeddings,
+            'discrim_net': discrim_net,
+            'pred_feat_emb': pred_feat_emb,
+            'layers': list(filter(None, nets)) + [discrim_net]}
+
+def compile_functions(model, keep_labels, missing_labels_val, alpha, beta,
+                      gamma, lmd, disc_nonlinearity, optimizer,
+                      freeze_aux=False):
+    '''
+    Defines the losses and updates of a model built by build_model and
+    compiles its functions. They are added to model along with the labels of
+    the monitored values and the optimizer state variables.
+
+    The evaluation functions use the embeddings predicted by the auxiliary
+    networks stored in shared variables, which refresh_embeddings updates.
+    With freeze_aux, the auxiliary networks are not trained and the training
+    function uses these variables as well.
+    '''
+    import lasagne
+    from lasagne.regularization import apply_penalty, l2
+    import theano
+    import model_helpers as mh
+
+    input_var_sup = model['input_var_sup']
+    input_var_unsup = model['input_var_unsup']
+    target_var_sup = model['target_var_sup']
+    reconst_target = model['reconst_target']
+    lr = model['lr']
+    nets = model['nets']
+    embeddings = model['embeddings']
+    discrim_net = model['discrim_net']
 
-    # Build and compile training functions
     predictions, predictions_det = mh.define_predictions(nets, start=2)
     prediction_sup, prediction_sup_det = mh.define_predictions([discrim_net])
     prediction_sup = prediction_sup[0]
@@ -163,7 +126,7 @@ def execute(args):
     # reconstruction losses
     reconst_losses, reconst_losses_det = mh.define_reconst_losses(
         predictions, predictions_det, [input_var_unsup, input_var_unsup,
-                                       input_var_sup])
+                                       reconst_target])
     # supervised loss
     sup_loss, sup_loss_det = mh.define_sup_loss(
         disc_nonlinearity, prediction_sup, prediction_sup_det, keep_labels,
@@ -186,19 +149,16 @@ def execute(args):
     params_to_freeze= \
         lasagne.layers.get_all_params(filter(None, nets), trainable=False,
                                       unwrap_shared=False)
+    if freeze_aux:
+        # Parameters of the networks predicting W_enc and W_dec
+        params_to_freeze += lasagne.layers.get_all_params(
+            list(filter(None, nets[:2])), unwrap_shared=False)
 
     # Remove unshared variables from params and params_to_freeze
     params = [p for p in params if isinstance(p, theano.compile.sharedvalue.SharedVariable)]
     params_to_freeze = [p for p in params_to_freeze if isinstance(p, theano.compile.sharedvalue.SharedVariable)]
     print('Params : ', params)
 
-    feat_emb_var = next(p for p in lasagne.layers.get_all_params([discrim_net]) if p.name == 'input_unsup' or p.name == 'feat_emb')
-    # feat_emb_var = lasagne.layers.get_all_params([discrim_net])[0]
-    print(feat_emb_var)
-    feat_emb_val = feat_emb_var.get_value()
-    feat_emb_norms = (feat_emb_val ** 2).sum(0) ** 0.5
-    feat_emb_var.set_value(feat_emb_val / feat_emb_norms)
-
     print('Number of params discrim: '+str(len(params)))
     print('Number of params to freeze: '+str(len(params_to_freeze)))
 
@@ -218,6 +178,14 @@ def execute(args):
     loss = loss + lmd*l2_penalty
     loss_det = loss_det + lmd*l2_penalty
 
+    # Embeddings computed once per refresh_embeddings call instead of once
+    # per batch
+    cached_embeddings, refresh_embeddings = mh.cache_embeddings(embeddings)
+    replace = dict((e, c) for e, c in zip(embeddings, cached_embeddings)
+                   if e is not None)
+    if freeze_aux:
+        loss = theano.clone(loss, replace=replace)
+
     # Compute network updates
     assert optimizer in ['rmsprop', 'adam']
     if optimizer == 'rmsprop':
@@ -239,10 +207,6 @@ def execute(args):
         if updates[k].ndim == 2:
             updates[k] = lasagne.updates.norm_constraint(updates[k], 1.0)
 
-    # Compile training function
-    train_fn = theano.function(inputs, loss, updates=updates,
-                               on_unused_input='ignore')
-
     # Monitoring Labels
     monitor_labels = ['reconst. feat. W_enc',
                       'reconst. feat. W_dec',
@@ -268,70 +232,454 @@ def execute(args):
     monitor_labels.append('accuracy')
     val_outputs.append(test_acc)
 
+    # The training function also returns the monitored values computed with
+    # the stochastic predictions, so that the training pass gives running
+    # estimates of the training metrics
+    train_outputs = [l for l in reconst_losses if l != 0]
+    train_outputs += [embeddings[0].mean(), embeddings[0].var()]
+    train_outputs += [embeddings[1].mean(), embeddings[1].var()] if \
+        (embeddings[1] is not None) else []
+    train_outputs += [sup_loss, loss]
+    train_acc, _ = mh.define_test_functions(
+        disc_nonlinearity, prediction_sup, prediction_sup, target_var_sup)
+    train_outputs.append(train_acc)
+
+    train_outputs = [prediction_sup] + train_outputs
+    if freeze_aux:
+        train_outputs = theano.clone(train_outputs, replace=replace)
+    val_outputs = theano.clone([prediction_sup_det] + val_outputs,
+                               replace=replace)
+    test_pred = theano.clone(test_pred, replace=replace)
+
+    # Compile training function
+    train_fn = theano.function(inputs, train_outputs,
+                               updates=updates, on_unused_input='ignore')
+
     # Compile prediction function
     predict = theano.function([input_var_sup], test_pred)
 
     # Compile validation function
-    val_fn = theano.function(inputs,
-                             [prediction_sup_det] + val_outputs,
-                             on_unused_input='ignore')
+    val_fn = theano.function(inputs, val_outputs, on_unused_input='ignore')
+
+    model.update({'train_fn': train_fn,
+                  'val_fn': val_fn,
+                  'predict': predict,
+                  'monitor_labels': monitor_labels,
+                  'cached_embeddings': [c for c in cached_embeddings
+                                        if c is not None],
+                  'refresh_embeddings': refresh_embeddings,
+                  # Optimizer accumulators
+                  'optimizer_state': [k for k in updates.keys()
+                                      if k not in params]})
+
+def get_data_vars(model):
+    # Shared variables holding the data of a run rather than parameters
+    return [model['input_var_unsup']] + model['norm_stats_vars']
+
+def restore_cached_model(cached_model, model, learning_rate):
+    '''
+    Sets the parameters and the data of a model loaded from the function cache
+    to the ones of the model built for this run, and returns it.
+    '''
+    import lasagne
+
+    # The values are set directly since the cached ones are placeholders whose
+    # shapes differ (see function_cache.save)
+    cached_vars = (lasagne.layers.get_all_params(cached_model['layers']) +
+                   get_data_vars(cached_model))
+    run_vars = (lasagne.layers.get_all_params(model['layers']) +
+                get_data_vars(model))
+    assert len(cached_vars) == len(run_vars)
+    for cached_var, var in zip(cached_vars, run_vars):
+        cached_var.set_value(var.get_value())
+    cached_model['lr'].set_value(np.float32(learning_rate))
+    return cached_model
+
+def save_state(writer, filename, model, epoch, patience, best_valid,
+               run_monitored, train_monitored, valid_monitored, train_loss,
+               learning_rate):
+    '''
+    Schedules the save of the complete training state with writer: the
+    parameters, the optimizer accumulators, the random states (numpy and
+    dropout), the learning rate, the number of epochs done, the early-stopping
+    state and the monitored histories, so that a job can be resumed exactly.
+    '''
+    import lasagne
+    import model_helpers as mh
+
+    arrays = {}
+    param_values = lasagne.layers.get_all_param_values(model['layers'])
+    for i, value in enumerate(param_values):
+        arrays['param_%d' % i] = value
+    for i, var in enumerate(model['optimizer_state']):
+        arrays['optimizer_%d' % i] = var.get_value()
+    for i, var in enumerate(mh.get_random_state_vars(model['layers'])):
+        arrays['random_%d' % i] = var.get_value()
+    _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+
+    writer.save(filename, epoch=epoch, patience=patience,
+                best_valid=best_valid, learning_rate=learning_rate,
+                run_monitored=np.array(run_monitored),
+                train_monitored=np.array(train_monitored),
+                valid_monitored=np.array(valid_monitored),
+                train_loss=np.array(train_loss),
+                rng_keys=keys, rng_pos=pos, rng_has_gauss=has_gauss,
+                rng_cached_gaussian=cached_gaussian, **arrays)
+
+def load_state(filename):
+    with np.load(filename) as f:
+        return dict((k, f[k]) for k in f.files)
+
+def get_state_arrays(state, prefix):
+    # Numbered arrays of a state, e.g. the parameters
+    nb_arrays = len([k for k in state if k.startswith(prefix + '_')])
+    return [state['%s_%d' % (prefix, i)] for i in range(nb_arrays)]
+
+def set_state(model, state):
+    '''
+    Sets the optimizer accumulators, the random states and the learning rate
+    of a compiled model, and the numpy random state, from a state loaded by
+    load_state.
+    '''
+    import model_helpers as mh
+
+    state_vars = [(model['optimizer_state'], 'optimizer'),
+                  (mh.get_random_state_vars(model['layers']), 'random')]
+    for variables, prefix in state_vars:
+        values = get_state_arrays(state, prefix)
+        assert len(values) == len(variables)
+        for var, value in zip(variables, values):
+            var.set_value(value)
+    model['lr'].set_value(np.float32(state['learning_rate']))
+    np.random.set_state(('MT19937', state['rng_keys'], int(state['rng_pos']),
+                         int(state['rng_has_gauss']),
+                         float(state['rng_cached_gaussian'])))
+
+# Main program
+def execute(args):
+    import lasagne
+    import function_cache
+    import model_helpers as mh
+
+    dataset = args.dataset
+    n_hidden_u = mlh.parse_int_list_arg(args.n_hidden_u)
+    n_hidden_t_enc = mlh.parse_int_list_arg(args.n_hidden_t_enc)
+    n_hidden_t_dec = mlh.parse_int_list_arg(args.n_hidden_t_dec)
+    n_hidden_s = mlh.parse_int_list_arg(args.n_hidden_s)
+    embedding_source = args.embedding_source
+    num_epochs = int(args.num_epochs)
+    learning_rate = args.learning_rate
+    learning_rate_annealing = args.learning_rate_annealing
+    alpha = args.alpha
+    beta = args.beta
+    gamma = args.gamma
+    lmd = args.lmd
+    disc_nonlinearity = args.disc_nonlinearity
+    encoder_net_init = args.encoder_net_init
+    decoder_net_init = args.decoder_net_init
+    optimizer = args.optimizer
+    max_patience = args.patience
+    batchnorm = args.batchnorm
+    keep_labels = args.keep_labels
+    prec_recall_cutoff = (args.prec_recall_cutoff != 0)
+    missing_labels_val = -1
+    which_fold = args.which_fold
+    early_stop_criterion = args.early_stop_criterion
+    save_path = args.save_tmp
+    save_copy = args.save_perm
+    dataset_path = args.dataset_path
+    resume = args.resume
+    exp_name = args.exp_name
+    random_proj = int(args.random_proj)
+    lazy_norm = args.lazy_norm != 0
+    nb_prefetch = args.prefetch
+    eval_batch_size = args.eval_batch_size
+    function_cache_dir = args.function_cache
+    monitor_train_every = args.monitor_train_every
+    profile_startup = args.profile_startup != 0
+    freeze_aux = args.freeze_aux != 0
+    sparse_input = args.sparse_input != 0
+    if sparse_input and not lazy_norm:
+        raise ValueError('--sparse_input requires --lazy_norm')
+    save_last_every = args.save_last_every
+    timer = timing.PhaseTimer(START_TIME)
+    timer.lap('imports')
+
+    # Prepare embedding information
+    if embedding_source is None or embedding_source == 'raw':
+        embedding_source = None
+        embedding_input = 'raw'
+    elif os.path.exists(embedding_source):
+        embedding_input = embedding_source
+    else:
+        embedding_input = embedding_source
+        embedding_ext = '.npz' if embedding_input == 'bag_of_genes' else '.npy'
+        embedding_source = os.path.join(dataset_path, embedding_input + '_fold' + str(which_fold) + embedding_ext)
+
+    # Load the dataset
+    print('Loading data')
+    data = mlh.load_data(dataset, dataset_path, embedding_source,
+                         which_fold=which_fold, keep_labels=keep_labels,
+                         missing_labels_val=missing_labels_val,
+                         embedding_input=embedding_input, lazy_norm=lazy_norm)
+    x_train, y_train, x_valid, y_valid, x_test, y_test, \
+        x_unsup, training_labels = data[:8]
+    # Statistics used to standardize the int8 genotypes batch by batch
+    norm_stats = data[8] if lazy_norm else None
+    # Statistics used by the minibatch iterators, the sparse inputs being
+    # standardized in the graph
+    batch_stats = None if sparse_input else norm_stats
+    timer.lap('data load')
+
+    if x_unsup is not None:
+        n_samples_unsup = x_unsup.shape[1]
+    else:
+        n_samples_unsup = 0
+
+    # Extract required information from data
+    n_samples, n_feats = x_train.shape
+    print('Number of features : ', n_feats)
+    print('Glorot init : ', 2.0 / (n_feats + n_hidden_t_enc[-1]))
+    n_targets = y_train.shape[1]
+
+    # Set some variables
+    batch_size = 128
+    beta = gamma if (gamma == 0) else beta
+
+    # Preparing folder to save stuff
+    if embedding_source is None:
+        embedding_name = embedding_input
+    else:
+        embedding_name = embedding_source.replace('_', '').split('.')[0]
+        exp_name += embedding_name.rsplit('/', 1)[::-1][0] + '_'
+
+    exp_name += mlh.define_exp_name(keep_labels, alpha, beta, gamma, lmd,
+                                    n_hidden_u, n_hidden_t_enc, n_hidden_t_dec,
+                                    n_hidden_s, which_fold,
+                                    learning_rate, decoder_net_init,
+                                    encoder_net_init, early_stop_criterion,
+                                    learning_rate_annealing)
+
+    print('Experiment: ' + exp_name)
+    save_path = os.path.join(save_path, dataset, exp_name)
+    save_copy = os.path.join(save_copy, dataset, exp_name)
+    if not os.path.exists(save_path):
+        os.makedirs(save_path)
+    if not os.path.exists(save_copy):
+        os.makedirs(save_copy)
+
+    # Build model
+    print('Building model')
+    model = build_model(embedding_source, n_feats, n_samples_unsup, n_targets,
+                        x_unsup, n_hidden_u, n_hidden_t_enc, n_hidden_t_dec,
+                        n_hidden_s, alpha, beta, gamma, disc_nonlinearity,
+                        batchnorm, encoder_net_init, decoder_net_init,
+                        learning_rate, save_path, random_proj, norm_stats,
+                        sparse_input)
+    timer.lap('graph build')
+
+    # Load the training state if we are resuming job
+    state = None
+    state_file = os.path.join(save_path, 'dietnet_state.npz')
+    if resume:
+        resume_file = state_file
+        if not os.path.exists(resume_file):
+            resume_file = os.path.join(save_copy, 'dietnet_state.npz')
+        if os.path.exists(resume_file):
+            print('Resuming from ' + resume_file)
+            state = load_state(resume_file)
+            param_values = get_state_arrays(state, 'param')
+        else:
+            # Only the weights of the last model
+            with np.load(os.path.join(save_copy, 'dietnet_last.npz')) as f:
+                param_values = [f['arr_%d' % i]
+                                for i in range(len(f.files))]
+        nlayers = len(lasagne.layers.get_all_params(model['layers']))
+        lasagne.layers.set_all_param_values(model['layers'],
+                                            param_values[:nlayers])
+
+    emb_params = dict((p.name, p) for p in
+                      lasagne.layers.get_all_params([model['discrim_net']]))
+    if 'feat_emb_data' in emb_params:
+        # Sparse embedding (see mh.sparse_shared): the columns are normalized
+        # through their nonzero values
+        feat_emb_var = emb_params['feat_emb_data']
+        print(feat_emb_var)
+        data = feat_emb_var.get_value()
+        indices = emb_params['feat_emb_indices'].get_value()
+        embedding_shape = tuple(emb_params['feat_emb_shape'].get_value())
+        feat_emb_norms = np.bincount(indices, weights=data ** 2,
+                                     minlength=embedding_shape[1]) ** 0.5
+        feat_emb_var.set_value((data / feat_emb_norms[indices]).astype(
+            data.dtype))
+    else:
+        feat_emb_var = next(p for p in emb_params.values() if p.name == 'input_unsup' or p.name == 'feat_emb')
+        # feat_emb_var = lasagne.layers.get_all_params([discrim_net])[0]
+        print(feat_emb_var)
+        feat_emb_val = feat_emb_var.get_value()
+        feat_emb_norms = (feat_emb_val ** 2).sum(0) ** 0.5
+        feat_emb_var.set_value(feat_emb_val / feat_emb_norms)
+        embedding_shape = feat_emb_val.shape
+
+    # The compiled functions only depend on the arguments shaping the graph,
+    # the parameter values and the data being held in shared variables
+    graph_args = dict(n_feats=n_feats, n_targets=n_targets,
+                      n_samples_unsup=n_samples_unsup,
+                      embedding_shape=embedding_shape,
+                      n_hidden_u=n_hidden_u, n_hidden_t_enc=n_hidden_t_enc,
+                      n_hidden_t_dec=n_hidden_t_dec, n_hidden_s=n_hidden_s,
+                      alpha=alpha, beta=beta, gamma=gamma, lmd=lmd,
+                      batchnorm=batchnorm, disc_nonlinearity=disc_nonlinearity,
+                      keep_labels=keep_labels,
+                      missing_labels_val=missing_labels_val,
+                      optimizer=optimizer, random_proj=random_proj,
+                      freeze_aux=freeze_aux,
+                      sparse_input=sparse_input)
+    cache_key = function_cache.get_key(graph_args, [mh.__file__, __file__])
+    cached_model = None
+    if function_cache_dir:
+        cached_model = function_cache.load(function_cache_dir, cache_key)
+
+    if cached_model is None:
+        print('Building and compiling training functions')
+        compile_functions(model, keep_labels, missing_labels_val, alpha, beta,
+                          gamma, lmd, disc_nonlinearity, optimizer,
+                          freeze_aux)
+        if function_cache_dir:
+            function_cache.save(function_cache_dir, cache_key, model,
+                                data_vars=get_data_vars(model) +
+                                model['cached_embeddings'],
+                                state_vars=model['optimizer_state'])
+    else:
+        print('Loaded the compiled functions from ' + function_cache_dir)
+        # Use the initial (or resumed) parameters and the data of this run
+        model = restore_cached_model(cached_model, model, learning_rate)
+    timer.lap('compile' if cached_model is None else 'cache load')
+
+    layers = model['layers']
+    lr = model['lr']
+    pred_feat_emb = model['pred_feat_emb']
+    train_fn = model['train_fn']
+    val_fn = model['val_fn']
+    predict = model['predict']
+    monitor_labels = model['monitor_labels']
+    refresh_embeddings = model['refresh_embeddings']
+    refresh_embeddings()
+
+    if profile_startup:
+        # The first call of a function allocates its storage. val_fn is used
+        # so that the parameters are not updated.
+        minibatch = next(mlh.iterate_minibatches(x_train, y_train,
+                                                 batch_size, shuffle=False,
+                                                 norm_stats=batch_stats,
+                                                 sparse=sparse_input))
+        val_fn(*minibatch)
+        timer.lap('first batch')
+        timer.report()
 
     # Finally, launch the training loop.
     print('Starting training...')
 
     # Some variables
+    start_epoch = 0
     patience = 0
+    # Checkpoints are written in the background
+    writer = checkpoint.CheckpointWriter()
 
+    # Running estimates of the train passes, deterministic monitoring of the
+    # training set (nan on the epochs without one) and of the validation set
+    run_monitored = []
     train_monitored = []
     valid_monitored = []
     train_loss = []
 
-    # Pre-training monitoring
-    print('Epoch 0 of {}'.format(num_epochs), end=' ')
+    if state is not None:
+        # Continue where the job stopped
+        set_state(model, state)
+        start_epoch = int(state['epoch'])
+        patience = int(state['patience'])
+        best_valid = state['best_valid'][()]
+        run_monitored = list(state['run_monitored'])
+        train_monitored = list(state['train_monitored'])
+        valid_monitored = list(state['valid_monitored'])
+        train_loss = list(state['train_loss'])
+        print('Resuming at epoch {}'.format(start_epoch + 1))
+    else:
+        # Pre-training monitoring
+        print('Epoch 0 of {}'.format(num_epochs), end=' ')
 
-    train_minibatches = mlh.iterate_minibatches(x_train, y_train,
-                                                batch_size, shuffle=False)
-    train_err = mlh.monitoring(train_minibatches, 'train', val_fn,
-                               monitor_labels, prec_recall_cutoff)
+        train_minibatches = mlh.iterate_minibatches(x_train, y_train,
+                                                    eval_batch_size,
+                                                    shuffle=False,
+                                                    norm_stats=batch_stats,
+                                                    sparse=sparse_input)
+        train_err = mlh.monitoring(train_minibatches, 'train', val_fn,
+                                   monitor_labels, prec_recall_cutoff)
+
+        valid_minibatches = mlh.iterate_minibatches(x_valid, y_valid,
+                                                    eval_batch_size,
+                                                    shuffle=False,
+                                                    norm_stats=batch_stats,
+                                                    sparse=sparse_input)
+        valid_err = mlh.monitoring(valid_minibatches, 'valid', val_fn,
+                                   monitor_labels, prec_recall_cutoff)
+        print('')
 
-    valid_minibatches = mlh.iterate_minibatches(x_valid, y_valid,
-                                                batch_size, shuffle=False)
-    valid_err = mlh.monitoring(valid_minibatches, 'valid', val_fn,
-                               monitor_labels, prec_recall_cutoff)
-    print('')
+    # Training history, one line per epoch
+    metrics_log = checkpoint.MetricsLog(
+        os.path.join(save_path, 'errors_supervised.csv'),
+        [which_set + '_' + checkpoint.column_name(label)
+         for which_set in ['run', 'train', 'valid']
+         for label in monitor_labels],
+        start_epoch)
 
     # Training loop
     start_training = time.time()
-    for epoch in range(num_epochs):
+    for epoch in range(start_epoch, num_epochs):
         start_time = time.time()
         print('Epoch {} of {}'.format(epoch+1, num_epochs), end=' ')
-        nb_minibatches = 0
-        loss_epoch = 0
-
-        # Train pass
-        for batch in mlh.iterate_minibatches(x_train, training_labels,
-                                             batch_size,
-                                             shuffle=True):
-            loss_epoch += train_fn(*batch)
-            nb_minibatches += 1
-
-        loss_epoch /= nb_minibatches
-        train_loss += [loss_epoch]
 
-        # Monitoring on the training set
-        train_minibatches = mlh.iterate_minibatches(x_train, y_train,
-                                                    batch_size, shuffle=False)
-        train_err = mlh.monitoring(train_minibatches, 'train', val_fn,
-                                   monitor_labels, prec_recall_cutoff)
+        # Train pass, accumulating the training metrics along the way
+        train_minibatches = mlh.iterate_minibatches(x_train, training_labels,
+                                                    batch_size,
+                                                    shuffle=True,
+                                                    norm_stats=batch_stats,
+                                                    sparse=sparse_input,
+                                                    nb_prefetch=nb_prefetch)
+        run_err = mlh.monitoring(train_minibatches, 'run', train_fn,
+                                 monitor_labels, prec_recall_cutoff)
+        train_loss += [run_err[monitor_labels.index('total loss')]]
+        run_monitored += [run_err]
+        if not freeze_aux:
+            # Predict W_enc and W_dec with the new parameters
+            refresh_embeddings()
+
+        # Deterministic monitoring on the training set, every
+        # monitor_train_every epochs
+        if monitor_train_every > 0 and (epoch + 1) % monitor_train_every == 0:
+            train_minibatches = mlh.iterate_minibatches(x_train, y_train,
+                                                        eval_batch_size,
+                                                        shuffle=False,
+                                                        norm_stats=batch_stats,
+                                                        sparse=sparse_input)
+            train_err = mlh.monitoring(train_minibatches, 'train', val_fn,
+                                       monitor_labels, prec_recall_cutoff)
+        else:
+            train_err = np.full(len(monitor_labels), np.nan)
         train_monitored += [train_err]
 
         # Monitoring on the validation set
         valid_minibatches = mlh.iterate_minibatches(x_valid, y_valid,
-                                                    batch_size, shuffle=False)
+                                                    eval_batch_size,
+                                                    shuffle=False,
+                                                    norm_stats=batch_stats,
+                                                    sparse=sparse_input)
 
         valid_err = mlh.monitoring(valid_minibatches, 'valid', val_fn,
                                    monitor_labels, prec_recall_cutoff)
         valid_monitored += [valid_err]
+        metrics_log.append(epoch + 1, list(run_err) + list(train_err) +
+                           list(valid_err))
 
         try:
             early_stop_val = valid_err[
@@ -354,42 +702,46 @@ def execute(args):
             patience = 0
 
             # Save stuff
-            np.savez(os.path.join(save_path, 'dietnet_best.npz'),
-                     *lasagne.layers.get_all_param_values(list(filter(None, nets)) +
-                                                          [discrim_net]))
-            np.savez(save_path + '/errors_supervised_best.npz',
-                     zip(*train_monitored), zip(*valid_monitored))
+            writer.save(os.path.join(save_path, 'dietnet_best.npz'),
+                        *lasagne.layers.get_all_param_values(layers))
+            save_state(writer, state_file, model, epoch + 1, patience,
+                       best_valid, run_monitored, train_monitored,
+                       valid_monitored, train_loss,
+                       lr.get_value() * learning_rate_annealing)
 
             # Monitor on the test set now because sometimes the saving doesn't
             # go well and there isn't a model to load at the end of training
             if y_test is not None:
                 test_minibatches = mlh.iterate_minibatches(x_test, y_test,
-                                                           138,
-                                                           shuffle=False)
+                                                           eval_batch_size,
+                                                           shuffle=False,
+                                                           norm_stats=batch_stats,
+                                                           sparse=sparse_input)
 
                 test_err = mlh.monitoring(test_minibatches, 'test', val_fn,
                                           monitor_labels, prec_recall_cutoff)
         else:
             patience += 1
-            # Save stuff
-            np.savez(os.path.join(save_path, 'dietnet_last.npz'),
-                     *lasagne.layers.get_all_param_values(list(filter(None, nets)) +
-                                                          [discrim_net]))
-            np.savez(save_path + '/errors_supervised_last.npz',
-                     zip(*train_monitored), zip(*valid_monitored))
+            # Save stuff, every save_last_every epochs
+            if save_last_every > 0 and (epoch + 1) % save_last_every == 0:
+                writer.save(os.path.join(save_path, 'dietnet_last.npz'),
+                            *lasagne.layers.get_all_param_values(layers))
+                save_state(writer, state_file, model, epoch + 1, patience,
+                           best_valid, run_monitored, train_monitored,
+                           valid_monitored, train_loss,
+                           lr.get_value() * learning_rate_annealing)
 
         # End training
         if patience == max_patience or epoch == num_epochs-1:
             print('Ending training')
-            # Load best model
+            # Load best model, once written
+            writer.flush()
             with np.load(os.path.join(save_path, 'dietnet_best.npz')) as f:
                 param_values = [f['arr_%d' % i]
                                 for i in range(len(f.files))]
-            nlayers = len(lasagne.layers.get_all_params(list(filter(None, nets)) +
-                                                        [discrim_net]))
-            lasagne.layers.set_all_param_values(list(filter(None, nets)) +
-                                                [discrim_net],
-                                                param_values[:nlayers])
+            nlayers = len(lasagne.layers.get_all_params(layers))
+            lasagne.layers.set_all_param_values(layers, param_values[:nlayers])
+            refresh_embeddings()
             if embedding_source is None:
                 # Save embedding
                 pred = pred_feat_emb()
@@ -397,28 +749,41 @@ def execute(args):
 
             # Training set results
             train_minibatches = mlh.iterate_minibatches(x_train, y_train,
-                                                        batch_size,
-                                                        shuffle=False)
+                                                        eval_batch_size,
+                                                        shuffle=False,
+                                                        norm_stats=batch_stats,
+                                                        sparse=sparse_input)
             train_err = mlh.monitoring(train_minibatches, 'train', val_fn,
                                        monitor_labels, prec_recall_cutoff)
 
             # Validation set results
             valid_minibatches = mlh.iterate_minibatches(x_valid, y_valid,
-                                                        batch_size,
-                                                        shuffle=False)
+                                                        eval_batch_size,
+                                                        shuffle=False,
+                                                        norm_stats=batch_stats,
+                                                        sparse=sparse_input)
             valid_err = mlh.monitoring(valid_minibatches, 'valid', val_fn,
                                        monitor_labels, prec_recall_cutoff)
 
             # Test set results
             if y_test is not None:
-                test_minibatches = mlh.iterate_minibatches(x_test, y_test, 138, shuffle=False)
+                test_minibatches = mlh.iterate_minibatches(x_test, y_test,
+                                                           eval_batch_size,
+                                                           shuffle=False,
+                                                           norm_stats=batch_stats,
+                                                           sparse=sparse_input)
 
                 test_err = mlh.monitoring(test_minibatches, 'test', val_fn, monitor_labels, prec_recall_cutoff)
             else:
-                for minibatch in mlh.iterate_testbatches(x_test, 138, shuffle=False):
-                    test_predictions = []
+                test_predictions = []
+                for minibatch in mlh.iterate_testbatches(x_test,
+                                                         eval_batch_size,
+                                                         shuffle=False,
+                                                         norm_stats=batch_stats,
+                                                         sparse=sparse_input):
                     test_predictions += [predict(minibatch)]
-                np.savez(os.path.join(save_path, 'test_predictions.npz'), test_predictions)
+                np.savez(os.path.join(save_path, 'test_predictions.npz'),
+                         np.concatenate(test_predictions))
 
             # Stop
             print('epoch time:{:6.3f}s'.format(time.time() - start_time))
@@ -432,6 +797,9 @@ def execute(args):
     # Print all final errors for train, validation and test
     print('Training time:\t\t\t{:.3f}s'.format(time.time() - start_training))
 
+    writer.close()
+    metrics_log.close()
+
     # Copy files to loadpath
     if save_path != save_copy:
         print('Copying model and other training files to {}'.format(save_copy))
@@ -471,6 +839,24 @@ def main():
     parser.add_argument('-exp_name', type=str, default='dietnets_final_',
             help='Experiment name that will be concatenated at the beginning of the generated name')
     parser.add_argument('--random_proj', '-rp', type=int, default=0, help='Whether to use random projections as embedding')
+    parser.add_argument('--lazy_norm', type=int, default=0,
+            help='Whether to keep the genotypes as int8 and standardize them one minibatch at a time')
+    parser.add_argument('--prefetch', type=int, default=2,
+            help='Number of training minibatches prepared in advance in a background thread (0 to disable)')
+    parser.add_argument('--eval_batch_size', type=int, default=1024,
+            help='Batch size used to monitor the train, valid and test sets')
+    parser.add_argument('--function_cache', default='',
+            help='Directory in which the compiled functions are cached, shared between runs with the same architecture')
+    parser.add_argument('--monitor_train_every', type=int, default=1,
+            help='Number of epochs between deterministic passes over the training set (0 to disable)')
+    parser.add_argument('--save_last_every', type=int, default=1,
+            help='Number of epochs between two saves of the last model (0 to disable)')
+    parser.add_argument('--sparse_input', type=int, default=0,
+            help='Whether to feed the genotypes as sparse matrices and standardize them in the first layer (requires --lazy_norm)')
+    parser.add_argument('--freeze_aux', type=int, default=0,
+            help='Whether to freeze the auxiliary networks predicting W_enc and W_dec, whose predictions are then computed once')
+    parser.add_argument('--profile_startup', type=int, default=0,
+            help='Whether to report the time spent importing, loading the data, building and compiling the model and running the first batch')
 
     args = parser.parse_args()
     print('Printing args')
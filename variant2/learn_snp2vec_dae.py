@@ -3,45 +3,72 @@ import time
 import os
 from distutils.dir_util import copy_tree
 
-import lasagne
-from lasagne.layers import DenseLayer, InputLayer
-from lasagne.nonlinearities import sigmoid, softmax, tanh, linear, rectify, leaky_rectify, very_leaky_rectify
-from lasagne.regularization import apply_penalty, l2, l1
-from lasagne.init import Uniform, GlorotUniform, GlorotNormal, Normal, He, HeNormal, HeUniform
 import numpy as np
-import theano
-import theano.tensor as T
 
 import mainloop_helpers as mlh
-import model_helpers as mh
 from mainloop_helpers import parse_string_int_tuple
 
+# Bits of every byte value, used to unpack bit-packed rows with np.take
+BYTE_BITS = np.unpackbits(np.arange(256, dtype='uint8')[:, None], axis=1)
+
 # creating data generator
-def data_generator(dataset, batch_size, shuffle=False, noise=0.5):
+# If nb_feats is given, the rows of dataset are bit-packed (np.packbits) and
+# are unpacked one minibatch at a time
+# The batches are written in two sets of preallocated buffers used in turn
+def data_generator(dataset, batch_size, shuffle=False, noise=0.5, nb_feats=None):
     nb_subjects = dataset.shape[0]
-    nb_feats = dataset.shape[1]
+    packed = nb_feats is not None
+    if not packed:
+        nb_feats = dataset.shape[1]
+    nb_SNPs = nb_feats // 2
 
     if shuffle:
         indices = np.random.permutation(nb_subjects)
     else:
         indices = np.arange(nb_subjects)
 
-    for i in range(0, nb_subjects - batch_size + 1, batch_size):
-        inputs = dataset[indices[i:i + batch_size], :]
-        n_in_batch = inputs.shape[0]
+    # The SNPs are kept if a uniform 16 bits draw is below keep_threshold
+    keep_threshold = int(round((1 - noise) * 2 ** 16))
 
-        # Keep a copy of the original inputs to act as a reconstruction target
-        reconstruction_targets = inputs.copy()
+    buffers = []
+    for _ in range(2):
+        if packed:
+            packed_buf = np.empty((batch_size, dataset.shape[1]), dtype='uint8')
+            target_buf = np.empty((batch_size, dataset.shape[1] * 8), dtype='uint8')
+        else:
+            packed_buf = None
+            target_buf = np.empty((batch_size, nb_feats), dtype=dataset.dtype)
+        input_buf = np.empty((batch_size, nb_feats), dtype=target_buf.dtype)
+        mask_buf = np.empty((batch_size, nb_SNPs), dtype='uint8')
+        buffers.append((packed_buf, target_buf, input_buf, mask_buf))
+
+    for n, i in enumerate(range(0, nb_subjects - batch_size + 1, batch_size)):
+        packed_buf, target_buf, input_buf, mask_buf = buffers[n % 2]
+        excerpt = indices[i:i + batch_size]
+
+        # The original inputs act as a reconstruction target
+        if packed:
+            np.take(dataset, excerpt, axis=0, out=packed_buf, mode='clip')
+            np.take(BYTE_BITS, packed_buf, axis=0, mode='clip',
+                    out=target_buf.reshape(batch_size, -1, 8))
+            reconstruction_targets = target_buf[:, :nb_feats]
+        else:
+            reconstruction_targets = np.take(dataset, excerpt, axis=0,
+                                             out=target_buf, mode='clip')
 
-        nb_SNPs = nb_feats / 2
-        snp_mask = np.random.binomial(1, 1-noise,
-                                      (n_in_batch, nb_SNPs)).astype('uint8')
-        inputs[:, ::2] *= snp_mask
-        inputs[:, 1::2] *= snp_mask
+        # Mask the two features of the dropped SNPs
+        inputs = input_buf
+        inputs[...] = reconstruction_targets
+        draws = np.frombuffer(np.random.bytes(2 * mask_buf.size), dtype='uint16')
+        np.less(draws.reshape(mask_buf.shape), keep_threshold, out=mask_buf)
+        inputs[:, ::2] *= mask_buf
+        inputs[:, 1::2] *= mask_buf
 
         yield inputs, reconstruction_targets
 
 def convert_initialization(component, nonlinearity='sigmoid'):
+    from lasagne.init import Uniform, GlorotUniform, GlorotNormal, Normal
+
     # component = init_dic[component_key]
     assert(len(component) == 2)
     if component[0] == 'uniform':
@@ -66,6 +93,14 @@ def execute(dataset, learning_rate=0.00001, learning_rate_annealing=1.0,
             num_epochs=500, which_fold=1,
             save_path=None, save_copy=None, dataset_path=None,
             num_fully_connected=0, exp_name='', init_args=None):
+    # Deferred so that --help and the data generator do not import Theano
+    import lasagne
+    from lasagne.layers import DenseLayer, InputLayer
+    from lasagne.nonlinearities import sigmoid, leaky_rectify
+    from lasagne.regularization import apply_penalty, l2, l1
+    from lasagne.init import Uniform
+    import theano
+    import theano.tensor as T
 
     # Reading dataset
     print('Loading data')
@@ -93,7 +128,10 @@ def execute(dataset, learning_rate=0.00001, learning_rate_annealing=1.0,
 
     print(x_train.shape, x_valid.shape)
 
-    n_features = x_train.shape[1]
+    # The snp2bin rows are bit-packed, get their unpacked width
+    with np.load(os.path.join(dataset_path,
+                              'snp_bin_packed_fold%d.npz' % which_fold)) as f:
+        n_features = int(f['nb_bits'])
 
     exp_name += 'learn_snp2vec_dae_h'
     for e in encoder_units:
@@ -200,7 +238,7 @@ def execute(dataset, learning_rate=0.00001, learning_rate_annealing=1.0,
     inputs = [input_var, target_reconst]
 
     # Compile training function
-    print 'Compiling training function'
+    print('Compiling training function')
     train_fn = theano.function(inputs, loss, updates=updates,
                                on_unused_input='ignore')
     val_fn = theano.function(inputs,
@@ -209,7 +247,7 @@ def execute(dataset, learning_rate=0.00001, learning_rate_annealing=1.0,
 
     start_training = time.time()
 
-    print 'Starting training'
+    print('Starting training')
     for epoch in range(num_epochs):
         start_time = time.time()
         print('Epoch {} of {}'.format(epoch+1, num_epochs))
@@ -217,7 +255,8 @@ def execute(dataset, learning_rate=0.00001, learning_rate_annealing=1.0,
         loss_epoch = 0
 
         for x, target_reconst_val in data_generator(x_train, batch_size,
-                                                    shuffle=True, noise=noise):
+                                                    shuffle=True, noise=noise,
+                                                    nb_feats=n_features):
             loss_epoch += train_fn(x, target_reconst_val)
             nb_minibatches += 1
 
@@ -225,13 +264,15 @@ def execute(dataset, learning_rate=0.00001, learning_rate_annealing=1.0,
         train_loss += [loss_epoch]
 
         # Monitoring on the training set
-        train_minibatches = data_generator(x_train, batch_size, noise=noise)
+        train_minibatches = data_generator(x_train, batch_size, noise=noise,
+                                           nb_feats=n_features)
         train_err = mlh.monitoring(train_minibatches, 'train', val_fn,
                                    monitor_labels, 0)
         train_monitored += [train_err]
 
         # Monitoring on the validation set
-        valid_minibatches = data_generator(x_valid, batch_size, noise=noise)
+        valid_minibatches = data_generator(x_valid, batch_size, noise=noise,
+                                           nb_feats=n_features)
 
         valid_err = mlh.monitoring(valid_minibatches, 'valid', val_fn,
                                    monitor_labels, 0)
@@ -316,12 +357,14 @@ def execute(dataset, learning_rate=0.00001, learning_rate_annealing=1.0,
                     all_embeddings)
 
             # Training set results
-            train_minibatches = data_generator(x_train, batch_size, noise=noise)
+            train_minibatches = data_generator(x_train, batch_size, noise=noise,
+                                               nb_feats=n_features)
             train_err = mlh.monitoring(train_minibatches, 'train', val_fn,
                                        monitor_labels, 0)
 
             # Validation set results
-            valid_minibatches = data_generator(x_valid, batch_size, noise=noise)
+            valid_minibatches = data_generator(x_valid, batch_size, noise=noise,
+                                               nb_feats=n_features)
             valid_err = mlh.monitoring(valid_minibatches, 'valid', val_fn,
                                        monitor_labels, 0)
 
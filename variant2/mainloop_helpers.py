@@ -1,12 +1,18 @@
 import numpy as np
 import os
 import random
+import threading
+from queue import Queue
+import scipy.sparse
 from common import dataset_utils
 
+import metrics
+
 # Function to load data
 def load_data(dataset, dataset_path, embedding_source,
               which_fold=0, keep_labels=1., missing_labels_val=1.,
-              embedding_input='raw', transpose=False, norm=True):
+              embedding_input='raw', transpose=False, norm=True,
+              lazy_norm=False):
 
     # Load data from specified dataset
     splits = [.6, .2]  # this will split the data into [60%, 20%, 20%]
@@ -20,18 +26,24 @@ def load_data(dataset, dataset_path, embedding_source,
                                     feature_splits=[.8],
                                     fold=which_fold,
                                     nolabels=embedding_input,
-                                    norm=norm, path=dataset_path)
+                                    norm=norm, path=dataset_path,
+                                    lazy_norm=lazy_norm)
     else:
         print('Unknown dataset')
         return
 
-    if not transpose:
-        (x_train, y_train), (x_valid, y_valid), (x_test, y_test), x_nolabel = data
-    else:
+    if transpose:
         return data
+    elif lazy_norm:
+        (x_train, y_train), (x_valid, y_valid), (x_test, y_test), x_nolabel, \
+            norm_stats = data
+    else:
+        (x_train, y_train), (x_valid, y_valid), (x_test, y_test), x_nolabel = data
 
     if not embedding_source:
-        if x_nolabel is None:
+        if x_nolabel is None and lazy_norm:
+            x_unsup = dataset_utils.standardize(x_train, norm_stats).transpose()
+        elif x_nolabel is None:
             x_unsup = x_train.transpose()
         else:
             x_unsup = x_nolabel
@@ -53,6 +65,10 @@ def load_data(dataset, dataset_path, embedding_source,
     else:
         training_labels = y_train
 
+    if lazy_norm:
+        return x_train, y_train, x_valid, y_valid, x_test, y_test, \
+            x_unsup, training_labels, norm_stats
+
     return x_train, y_train, x_valid, y_valid, x_test, y_test, \
         x_unsup, training_labels
 
@@ -84,99 +100,203 @@ def define_exp_name(keep_labels, alpha, beta, gamma, lmd, n_hidden_u,
 
     return exp_name
 
+def prefetch(batches, nb_prefetch=2):
+    '''
+    Iterates over batches while a background thread prepares up to
+    nb_prefetch of the next ones, so that gathering the data of a batch
+    overlaps with the computations on the previous one.
+    '''
+    queue = Queue(maxsize=nb_prefetch)
+    done = object()
+    stop = threading.Event()
+
+    def producer():
+        try:
+            for batch in batches:
+                if stop.is_set():
+                    return
+                queue.put(batch)
+            queue.put(done)
+        except Exception as e:
+            queue.put(e)
+
+    thread = threading.Thread(target=producer)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            batch = queue.get()
+            if batch is done:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+    finally:
+        # Unblock the producer if the iteration is interrupted
+        stop.set()
+        while thread.is_alive():
+            while not queue.empty():
+                queue.get()
+            thread.join(0.01)
+
+def _minibatches(inputs, targets, indices, batchsize, norm_stats=None,
+                 nb_buffers=2, sparse=False):
+    # The batches are gathered in nb_buffers preallocated arrays used in turn:
+    # a yielded batch is overwritten nb_buffers batches later, so callers that
+    # keep batches around must copy them. The last batch holds the remaining
+    # samples and may be smaller than batchsize.
+    # With sparse, int8 genotypes are yielded as float32 CSR matrices, missing
+    # calls being counted as 0, and are not standardized.
+    assert not (sparse and norm_stats is not None)
+    nb_samples = inputs.shape[0]
+    batchsize = max(min(batchsize, nb_samples), 1)
+    nb_batches = (nb_samples + batchsize - 1) // batchsize
+    nb_buffers = max(min(nb_buffers, nb_batches), 1)
+    input_bufs = [np.empty((batchsize,) + inputs.shape[1:], dtype=inputs.dtype)
+                  for _ in range(nb_buffers)]
+    if norm_stats is not None:
+        float_bufs = [np.empty(buf.shape, dtype='float32')
+                      for buf in input_bufs]
+    if targets is not None:
+        target_bufs = [np.empty((batchsize,) + targets.shape[1:],
+                                dtype=targets.dtype)
+                       for _ in range(nb_buffers)]
+
+    for n, i in enumerate(range(0, nb_samples, batchsize)):
+        k = n % nb_buffers
+        excerpt = indices[i:i+batchsize]
+        size = len(excerpt)
+        # mode='clip' avoids the extra buffering np.take does with 'raise'
+        batch = np.take(inputs, excerpt, axis=0, out=input_bufs[k][:size],
+                        mode='clip')
+        if norm_stats is not None:
+            batch = dataset_utils.standardize(batch, norm_stats,
+                                              out=float_bufs[k][:size])
+        elif sparse:
+            # MISSING_GENOTYPE is the only negative code
+            np.maximum(batch, 0, out=batch)
+            batch = scipy.sparse.csr_matrix(batch, dtype='float32')
+        if targets is None:
+            yield batch
+        else:
+            yield batch, np.take(targets, excerpt, axis=0,
+                                 out=target_bufs[k][:size], mode='clip')
+
 # Mini-batch iterator function
+# If norm_stats is given, inputs are int8 genotypes standardized batch by batch
+# If sparse, inputs are int8 genotypes yielded as CSR matrices (see
+# model_helpers.StandardizedSparseDenseLayer)
+# If nb_prefetch > 0, batches are prepared in advance in a background thread
+# The yielded arrays are reused by later batches
 def iterate_minibatches(inputs, targets, batchsize,
-                        shuffle=False):
+                        shuffle=False, norm_stats=None, nb_prefetch=0,
+                        sparse=False):
     assert inputs.shape[0] == targets.shape[0]
     indices = np.arange(inputs.shape[0])
     if shuffle:
         indices = np.random.permutation(inputs.shape[0])
 
-    for i in range(0, inputs.shape[0]-batchsize+1, batchsize):
-        yield inputs[indices[i:i+batchsize], :],\
-            targets[indices[i:i+batchsize]]
+    # Besides the batches waiting in the queue, one is being filled by the
+    # producer and one is used by the caller
+    batches = _minibatches(inputs, targets, indices, batchsize, norm_stats,
+                           nb_buffers=nb_prefetch + 2, sparse=sparse)
+    if nb_prefetch > 0:
+        batches = prefetch(batches, nb_prefetch)
+    return batches
 
 def iterate_minibatches_unsup(x, batch_size, shuffle=False):
     indices = np.arange(x.shape[0])
     if shuffle:
         indices = np.random.permutation(x.shape[0])
-    for i in range(0, x.shape[0]-batch_size+1, batch_size):
-        yield x[indices[i:i+batch_size], :]
+    return _minibatches(x, None, indices, batch_size)
 
-def iterate_testbatches(inputs, batchsize, shuffle=False):
+def iterate_testbatches(inputs, batchsize, shuffle=False, norm_stats=None,
+                        sparse=False):
     indices = np.arange(inputs.shape[0])
     if shuffle:
         indices = np.random.permutation(inputs.shape[0])
-    for i in range(0, inputs.shape[0]-batchsize+1, batchsize):
-        yield inputs[indices[i:i+batchsize], :]
+    return _minibatches(inputs, None, indices, batchsize, norm_stats,
+                        sparse=sparse)
 
 def get_precision_recall_cutoff(predictions, targets):
+    '''
+    Returns the precision/recall breakeven point of the predictions, all
+    entries of the prediction matrix being taken together (see
+    metrics.breakeven_point).
 
-    prev_threshold = 0.00
-    threshold_inc = 0.10
+    The whole precision/recall curve is computed at once, from the entries
+    sorted by decreasing prediction, and only the distinct prediction values
+    are used as thresholds.
+    '''
+    predictions = np.asarray(predictions).ravel()
+    targets = np.asarray(targets).ravel()
 
-    while True:
-        if prev_threshold > 1.000:
-            cutoff = 0.0
-            break
+    nb_positives = (targets == 1).sum()
+    order = np.argsort(-predictions, kind='mergesort')
+    sorted_predictions = predictions[order]
+    tp = np.cumsum(targets[order] == 1)
+    fp = np.cumsum(targets[order] == 0)
 
-        threshold = prev_threshold + threshold_inc
-        tp = ((predictions >= threshold) * (targets == 1)).sum()
-        fp = ((predictions >= threshold) * (targets == 0)).sum()
-        fn = ((predictions < threshold) * (targets == 1)).sum()
+    # Keep the last entry of each run of tied predictions
+    last_of_run = np.append(sorted_predictions[1:] != sorted_predictions[:-1],
+                            True)
+    tp = tp[last_of_run]
+    fp = fp[last_of_run]
 
-        precision = float(tp) / (tp + fp + 1e-20)
-        recall = float(tp) / (tp + fn + 1e-20)
-
-        if precision > recall:
-            if threshold_inc < 0.001:
-                cutoff = recall
-                break
-            else:
-                threshold_inc /= 10
-        else:
-            prev_threshold += threshold_inc
-
-    return cutoff
+    return metrics.breakeven_point(tp, fp, nb_positives)
 
 # Monitoring function
 def monitoring(minibatches, which_set, error_fn, monitoring_labels,
                prec_recall_cutoff=True, start=1, return_pred=False):
     print('')
     prec_recall_cutoff = False if start == 0 else prec_recall_cutoff
-    monitoring_values = np.zeros(len(monitoring_labels), dtype='float32')
-    global_batches = 0
+    mean_values = metrics.MeanAccumulator(len(monitoring_labels))
+    # The breakeven point is computed exactly from the kept predictions if
+    # they are returned, and approximately from their histogram otherwise
+    if prec_recall_cutoff and not return_pred:
+        prec_recall = metrics.PrecisionRecallHistogram()
 
+    # Predictions and targets are only kept if they are returned
     targets = []
     predictions = []
 
     for batch in minibatches:
-        # Update monitored values
+        # Update monitored values, weighted by the size of the batch since
+        # the last one may be smaller
         if start == 0:
             out = error_fn(batch)
+            batch_size = batch.shape[0]
         else:
             out = error_fn(*batch)
+            batch_size = batch[0].shape[0]
 
-        monitoring_values = monitoring_values + out[start:]
-        if start == 1:
+        mean_values.update(out[start:], batch_size)
+        if prec_recall_cutoff and not return_pred:
+            prec_recall.update(out[0], batch[1])
+        if return_pred:
             predictions.append(out[0])
-        targets.append(batch[1])
-        global_batches += 1
+            # The batch arrays are reused by the iterators
+            targets.append(np.array(batch[1]))
 
     # Print monitored values
-    monitoring_values /= global_batches
+    monitoring_values = mean_values.result()
     for (label, val) in zip(monitoring_labels, monitoring_values):
         print ('{:5s} {}:{:9.6f}'.format(which_set, label, val), end=' ')
 
-    # If needed, compute and print the precision-recall breakoff point
-    if prec_recall_cutoff:
+    # If needed, print the precision-recall breakoff point
+    if return_pred:
         predictions = np.vstack(predictions)
         targets = np.vstack(targets)
-        cutoff = get_precision_recall_cutoff(predictions, targets)
+    if prec_recall_cutoff:
+        if return_pred:
+            cutoff = get_precision_recall_cutoff(predictions, targets)
+        else:
+            cutoff = prec_recall.result()
         print ('{:5s} precis/recall cutoff:{:9.6f}'.format(which_set, cutoff), end=' ')
 
     if return_pred:
-        return monitoring_values, np.vstack(predictions), np.vstack(targets)
+        return monitoring_values, predictions, targets
     else:
         return monitoring_values
 
@@ -0,0 +1,135 @@
+import numpy as np
+
+
+def breakeven_point(tp, fp, nb_positives):
+    '''
+    Returns the precision/recall breakeven point given the cumulative true
+    and false positive counts at a decreasing sequence of thresholds.
+
+    The breakeven point is the value at which the precision and recall curves
+    cross, interpolated linearly between two thresholds when they do not
+    cross exactly at one of them. Returns 0.0 if there is no positive or if
+    precision is below recall at every threshold.
+    '''
+    if nb_positives == 0:
+        return 0.0
+
+    precision = tp / np.maximum(tp + fp, 1).astype('float64')
+    recall = tp / float(nb_positives)
+
+    # Going down the thresholds, recall increases up to 1. The curves cross
+    # after the last threshold where precision is still above recall.
+    diff = precision - recall
+    above = np.nonzero(diff > 0)[0]
+    if len(above) == 0:
+        # The curves may still cross at the first threshold
+        return float(recall[0]) if diff[0] == 0 else 0.0
+    i = above[-1]
+    t = diff[i] / (diff[i] - diff[i + 1])
+
+    return float(recall[i] + t * (recall[i + 1] - recall[i]))
+
+
+def confusion_matrix(predictions, targets, nb_classes):
+    '''
+    Returns the confusion counts of class indices: cm[i, j] is the number of
+    samples of class j predicted as class i.
+    '''
+    predictions = np.asarray(predictions, dtype='int64')
+    targets = np.asarray(targets, dtype='int64')
+    cm = np.bincount(predictions * nb_classes + targets,
+                     minlength=nb_classes * nb_classes)
+    return cm.reshape(nb_classes, nb_classes)
+
+
+def group_lookup(groups, nb_classes):
+    '''
+    Returns the array mapping each class to the index of its group, given the
+    groups as lists of class indices (e.g. the continents of the ethnicities
+    from model_helpers.create_1000_genomes_continent_labels).
+    '''
+    lookup = np.zeros(nb_classes, dtype='int64')
+    for i, group in enumerate(groups):
+        lookup[group] = i
+    return lookup
+
+
+def aggregate_confusion(cm, lookup, nb_groups):
+    '''
+    Returns the confusion counts between groups of classes given the
+    confusion counts between classes and the class to group lookup array.
+    '''
+    rows = lookup[:, None] * nb_groups + lookup[None, :]
+    cm_groups = np.bincount(rows.ravel(), weights=np.ravel(cm),
+                            minlength=nb_groups * nb_groups)
+    return cm_groups.reshape(nb_groups, nb_groups)
+
+
+def sum_confusions(filenames):
+    '''
+    Returns the sums of the ethnicity (cm_e) and continent (cm_c) confusion
+    counts saved in the given cm*.npz files, e.g. the ones of all the folds.
+    '''
+    cm_e = 0
+    cm_c = 0
+    for filename in filenames:
+        with np.load(filename) as f:
+            cm_e = cm_e + f['cm_e']
+            cm_c = cm_c + f['cm_c']
+    return cm_e, cm_c
+
+
+class MeanAccumulator(object):
+    """
+    Running mean of a vector of monitored values (losses, accuracy, ...)
+    computed on batches, weighted by the number of samples of each batch.
+
+    Parameters
+    ----------
+    nb_values : int
+        Number of monitored values.
+    """
+    def __init__(self, nb_values):
+        self.total = np.zeros(nb_values, dtype='float64')
+        self.nb_samples = 0
+
+    def update(self, values, nb_samples):
+        self.total += nb_samples * np.asarray(values, dtype='float64')
+        self.nb_samples += nb_samples
+
+    def result(self):
+        return (self.total / max(self.nb_samples, 1)).astype('float32')
+
+
+class PrecisionRecallHistogram(object):
+    """
+    Histograms of the predictions of the positive and negative targets, from
+    which the precision/recall breakeven point is computed with a resolution
+    of 1 / nb_bins. Predictions are clipped to [0, 1] and targets equal to
+    neither 0 nor 1 (missing labels) are ignored.
+
+    Parameters
+    ----------
+    nb_bins : int
+        Number of thresholds, evenly spaced in [0, 1].
+    """
+    def __init__(self, nb_bins=10000):
+        self.nb_bins = nb_bins
+        self.positives = np.zeros(nb_bins, dtype='int64')
+        self.negatives = np.zeros(nb_bins, dtype='int64')
+
+    def update(self, predictions, targets):
+        predictions = np.asarray(predictions).ravel()
+        targets = np.asarray(targets).ravel()
+        bins = np.clip(predictions * self.nb_bins, 0, self.nb_bins - 1)
+        bins = bins.astype('int64')
+        self.positives += np.bincount(bins[targets == 1],
+                                      minlength=self.nb_bins)
+        self.negatives += np.bincount(bins[targets == 0],
+                                      minlength=self.nb_bins)
+
+    def result(self):
+        # Cumulative counts from the highest threshold down
+        tp = np.cumsum(self.positives[::-1])
+        fp = np.cumsum(self.negatives[::-1])
+        return breakeven_point(tp, fp, self.positives.sum())
@@ -1,4 +1,5 @@
 import numpy as np
+import scipy.sparse
 import os
 
 import lasagne
@@ -7,6 +8,7 @@ from lasagne.nonlinearities import sigmoid, softmax, tanh, linear, rectify, leak
 from lasagne.init import Uniform
 import theano
 import theano.tensor as T
+import theano.sparse
 from theano.tensor.shared_randomstreams import RandomStreams
 
 _EPSILON = 10e-8
@@ -18,6 +20,7 @@ def build_feat_emb_nets(embedding_source, n_feats, n_samples_unsup,
 
     nets = []
     embeddings = []
+    sparse_emb = False
 
     if not embedding_source:  # meaning we haven't done any unsup pre-training
         encoder_net = InputLayer((n_feats, n_samples_unsup), input_var_unsup)
@@ -37,7 +40,15 @@ def build_feat_emb_nets(embedding_source, n_feats, n_samples_unsup,
             path_to_load = os.path.join(save_path.rsplit('/', 1)[0],
                                         embedding_source)
         if embedding_source[-3:] == "npz":
-            feat_emb_val = np.load(path_to_load).items()[0][1]
+            with np.load(path_to_load) as f:
+                sparse_emb = 'indptr' in f.files
+                if not sparse_emb:
+                    feat_emb_val = f[f.files[0]]
+            if sparse_emb:
+                # scipy.sparse embedding (bag_of_genes), kept sparse in the
+                # graph
+                feat_emb_val = scipy.sparse.load_npz(path_to_load).tocsr()
+                feat_emb_val = feat_emb_val.astype('float32')
         else:
             feat_emb_val = np.load(path_to_load)
             feat_emb_val = feat_emb_val.astype('float32')
@@ -47,17 +58,25 @@ def build_feat_emb_nets(embedding_source, n_feats, n_samples_unsup,
             # feat_emb_val /= stds[:, None]
 
 
-        feat_emb = theano.shared(feat_emb_val, 'feat_emb')
+        if sparse_emb:
+            feat_emb = sparse_shared(feat_emb_val, 'feat_emb')
+        else:
+            feat_emb = theano.shared(feat_emb_val, 'feat_emb')
         encoder_net = InputLayer((n_feats, feat_emb_val.shape[1]), feat_emb)
 
+    # The first layer of the auxiliary networks multiplies a sparse embedding
+    # without densifying it
+    first_layer = SparseDenseLayer if sparse_emb else DenseLayer
+
     # Build transformations (f_theta, f_theta') network and supervised network
     # f_theta (ou W_enc)
     encoder_net_W_enc = encoder_net
-    for hid in n_hidden_t_enc:
-        encoder_net_W_enc = DenseLayer(encoder_net_W_enc, num_units=hid,
-                                       nonlinearity=tanh,  # tanh
-                                       W=Uniform(encoder_net_init)
-                                       )
+    for i, hid in enumerate(n_hidden_t_enc):
+        layer = first_layer if i == 0 else DenseLayer
+        encoder_net_W_enc = layer(encoder_net_W_enc, num_units=hid,
+                                  nonlinearity=tanh,  # tanh
+                                  W=Uniform(encoder_net_init)
+                                  )
         # encoder_net_W_enc = DropoutLayer(encoder_net_W_enc)
         # encoder_net = BatchNormLayer(encoder_net_W_enc)
     enc_feat_emb = lasagne.layers.get_output(encoder_net_W_enc)
@@ -68,11 +87,12 @@ def build_feat_emb_nets(embedding_source, n_feats, n_samples_unsup,
     # f_theta' (ou W_dec)
     if gamma > 0:  # meaning we are going to train to reconst the fat data
         encoder_net_W_dec = encoder_net
-        for hid in n_hidden_t_dec:
-            encoder_net_W_dec = DenseLayer(encoder_net_W_dec, num_units=hid,
-                                           nonlinearity=tanh,  # tanh
-                                           W=Uniform(decoder_net_init)
-                                           )
+        for i, hid in enumerate(n_hidden_t_dec):
+            layer = first_layer if i == 0 else DenseLayer
+            encoder_net_W_dec = layer(encoder_net_W_dec, num_units=hid,
+                                      nonlinearity=tanh,  # tanh
+                                      W=Uniform(decoder_net_init)
+                                      )
             # encoder_net_W_dec = DropoutLayer(encoder_net_W_dec)
             # encoder_net = BatchNormLayer(encoder_net_W_dec)
         dec_feat_emb = lasagne.layers.get_output(encoder_net_W_dec)
@@ -113,11 +133,18 @@ def build_feat_emb_reconst_nets(coeffs, n_feats, n_hidden_u,
 
 def build_discrim_net(batch_size, n_feats, input_var_sup, n_hidden_t_enc,
                       n_hidden_s, embedding, disc_nonlinearity, n_targets,
-                      batchnorm=False):
+                      batchnorm=False, norm_stats_vars=None):
     # Supervised network
+    # With norm_stats_vars, the (mu, sigma) shared variables, input_var_sup
+    # is a sparse matrix of unstandardized genotypes
     discrim_net = InputLayer((batch_size, n_feats), input_var_sup)
-    discrim_net = DenseLayer(discrim_net, num_units=n_hidden_t_enc[-1],
-                             W=embedding, nonlinearity=rectify)
+    if norm_stats_vars is None:
+        discrim_net = DenseLayer(discrim_net, num_units=n_hidden_t_enc[-1],
+                                 W=embedding, nonlinearity=rectify)
+    else:
+        discrim_net = StandardizedSparseDenseLayer(
+            discrim_net, norm_stats_vars[0], norm_stats_vars[1],
+            num_units=n_hidden_t_enc[-1], W=embedding, nonlinearity=rectify)
     hidden_rep = discrim_net
 
     # Supervised hidden layers
@@ -159,6 +186,30 @@ def build_reconst_net(hidden_rep, embedding, n_feats, gamma):
 
     return reconst_net
 
+def cache_embeddings(embeddings):
+    '''
+    Returns shared variables holding the values of the embeddings predicted
+    by the auxiliary networks (None where there is no embedding) and a
+    function setting them to the current predictions.
+
+    Replacing the embeddings by these variables in a graph (theano.clone)
+    avoids running the auxiliary networks over all the features at every
+    call, as long as the function is called whenever their parameters change.
+    '''
+    cached_embeddings = []
+    updates = []
+    for i, embedding in enumerate(embeddings):
+        if embedding is None:
+            cached_embeddings.append(None)
+            continue
+        cached = theano.shared(np.zeros((0, 0), dtype=embedding.dtype),
+                               'cached_feat_emb%d' % i)
+        cached_embeddings.append(cached)
+        updates.append((cached, embedding))
+    refresh = theano.function([], [], updates=updates)
+
+    return cached_embeddings, refresh
+
 def define_predictions(nets, start=0):
     preds = []
     preds_det = []
@@ -270,6 +321,19 @@ def define_test_functions(disc_nonlinearity, prediction, prediction_det,
                               dtype=theano.config.floatX) * 100
         return test_acc, test_pred
 
+def get_random_state_vars(layers):
+    '''
+    Returns the shared variables holding the states of the random streams of
+    the layers (e.g. of the dropout masks), which are updated by the compiled
+    functions.
+    '''
+    state_vars = []
+    for layer in lasagne.layers.get_all_layers(layers):
+        srng = getattr(layer, '_srng', None)
+        if srng is not None:
+            state_vars += [state for state, _ in srng.state_updates]
+    return state_vars
+
 def create_1000_genomes_continent_labels():
     labels = ['ACB', 'ASW', 'BEB', 'CDX', 'CEU', 'CHB', 'CHS', 'CLM', 'ESN',
               'FIN', 'GBR', 'GIH', 'GWD', 'IBS', 'ITU', 'JPT', 'KHV', 'LWK',
@@ -371,6 +435,65 @@ class HierarchicalMergeSoftmaxLayer(MergeLayer):
 
         return output
 
+def sparse_shared(value, name):
+    '''
+    Returns a Theano CSR matrix built from shared variables holding the data,
+    indices, indptr and shape of the scipy.sparse matrix value. They are
+    named name + '_data', ... and, unlike a sparse shared variable, their
+    values are numpy arrays which can be saved with the parameters.
+    '''
+    value = scipy.sparse.csr_matrix(value)
+    data = theano.shared(value.data, name + '_data')
+    indices = theano.shared(value.indices.astype('int32'), name + '_indices')
+    indptr = theano.shared(value.indptr.astype('int32'), name + '_indptr')
+    shape = theano.shared(np.array(value.shape, dtype='int32'), name + '_shape')
+    return theano.sparse.CSR(data, indices, indptr, shape)
+
+class SparseDenseLayer(DenseLayer):
+    """
+    Dense layer whose input is a sparse matrix, multiplied by the weights
+    with a sparse-dense product.
+    """
+    def get_output_for(self, input, **kwargs):
+        activation = theano.sparse.structured_dot(input, self.W)
+        if self.b is not None:
+            activation = activation + self.b.dimshuffle('x', 0)
+        return self.nonlinearity(activation)
+
+class StandardizedSparseDenseLayer(DenseLayer):
+    """
+    Dense layer applied to the standardized genotypes (x - mu) / sigma given
+    the sparse matrix of the unstandardized genotypes x. The standardization
+    is folded in the weights so that x is never densified:
+
+        dot((x - mu) / sigma, W) = dot(x, W / sigma[:, None])
+                                   - dot(mu / sigma, W)
+
+    and only the nonzero genotypes take part in the sparse-dense product.
+    The parameters are those of a DenseLayer, so the model can be saved and
+    loaded as one using dense inputs.
+
+    Parameters
+    ----------
+    incoming : a :class:`Layer` instance or a tuple
+        The layer feeding into this layer, whose output is a sparse matrix.
+    mu, sigma : Theano shared variables
+        Mean and standard deviation vectors of the genotypes (see
+        common.dataset_utils.compute_stats).
+    """
+    def __init__(self, incoming, mu, sigma, **kwargs):
+        super(StandardizedSparseDenseLayer, self).__init__(incoming, **kwargs)
+        self.mu = mu
+        self.sigma = sigma
+
+    def get_output_for(self, input, **kwargs):
+        activation = theano.sparse.structured_dot(
+            input, self.W / self.sigma.dimshuffle(0, 'x'))
+        activation = activation - T.dot(self.mu / self.sigma, self.W)
+        if self.b is not None:
+            activation = activation + self.b.dimshuffle('x', 0)
+        return self.nonlinearity(activation)
+
 def define_sampled_mean_bincrossentropy(y_pred, x, gamma=.5, one_ratio=.25,
                                         random_stream=RandomStreams(seed=1)):
 
@@ -16,21 +16,39 @@ def plot(dataset,
         if not os.path.exists(file_path):
             raise ValueError('The path to {} does not exist'.format(file_path))
 
-        error_var = np.load(os.path.join(file_path, 'errors_supervised_last.npz'))
+        log_file = os.path.join(file_path, 'errors_supervised.csv')
+        if os.path.exists(log_file):
+            # Written one epoch at a time, it can be read during training
+            errors = np.genfromtxt(log_file, delimiter=',', names=True,
+                                   ndmin=1)
+            train_loss = errors['train_total_loss']
+            train_acc = errors['train_accuracy']
+            valid_loss = errors['valid_total_loss']
+            valid_acc = errors['valid_accuracy']
+            epochs = errors['epoch']
+        else:
+            # Models trained before the log was introduced
+            error_var = np.load(os.path.join(file_path,
+                                             'errors_supervised_last.npz'))
+
+            train_loss = error_var['arr_0'][-2]
+            train_acc = error_var['arr_0'][-1]
+            valid_loss = error_var['arr_1'][-2]
+            valid_acc = error_var['arr_1'][-1]
 
-        train_loss = error_var['arr_0'][-2]
-        train_acc = error_var['arr_0'][-1]
-        valid_loss = error_var['arr_1'][-2]
-        valid_acc = error_var['arr_1'][-1]
+            max_epoch = len(train_loss)
+            epochs = np.arange(max_epoch)
 
-        max_epoch = len(train_loss)
-        epochs = range(max_epoch)
+        # The training set is only monitored every monitor_train_every epochs
+        train_epochs = ~np.isnan(train_loss)
 
         if metric == 'loss':
-            plt.plot(epochs, train_loss, '-'+c, label='train_loss: '+m)
+            plt.plot(epochs[train_epochs], train_loss[train_epochs], '-'+c,
+                     label='train_loss: '+m)
             plt.plot(epochs, valid_loss, '--'+c, label='val_loss: '+m)
         elif metric == 'acc':
-            plt.plot(epochs, train_acc, '-'+c, label='train_acc: '+m)
+            plt.plot(epochs[train_epochs], train_acc[train_epochs], '-'+c,
+                     label='train_acc: '+m)
             plt.plot(epochs, valid_acc, '--'+c, label='val_acc: '+m)
         else:
             raise ValueError('Unknown metric')
@@ -5,26 +5,24 @@ import os
 
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 
+import metrics
+
 def plot(dataset,
          metric='loss',
          model_path=None,
          models=None,
          colors=None):
 
-    cm_eth_tot = np.zeros((26, 26))
-    cm_cont_tot = np.zeros((5, 5))
-
+    filenames = []
     for m in models:
         file_path = os.path.join(model_path, dataset, m)
         if not os.path.exists(file_path):
             raise ValueError('The path to {} does not exist'.format(file_path))
+        filenames.append(os.path.join(file_path, 'cm'+m[-1]+'.npz'))
 
-        cm_var = np.load(os.path.join(file_path, 'cm'+m[-1]+'.npz'))
-        cm_eth_tot += cm_var['cm_e']
-        cm_cont_tot += cm_var['cm_c']
-
-    cm_eth_tot /= 5
-    cm_cont_tot /= 5
+    cm_eth_tot, cm_cont_tot = metrics.sum_confusions(filenames)
+    cm_eth_tot = cm_eth_tot / float(len(models))
+    cm_cont_tot = cm_cont_tot / float(len(models))
 
     # Normalize
     cm_eth_tot /= cm_eth_tot.sum(0)
@@ -1,26 +1,19 @@
-import argparse
 import time
+# Start of the imports phase of --profile_startup
+START_TIME = time.time()
+
+import argparse
 import os
 import random
 from distutils.dir_util import copy_tree
 
-import lasagne
-from lasagne.layers import DenseLayer, InputLayer, DropoutLayer, BatchNormLayer
-from lasagne.nonlinearities import (sigmoid, softmax, tanh, linear, rectify,
-                                    leaky_rectify, very_leaky_rectify)
-from lasagne.regularization import apply_penalty, l2
-
-from lasagne.init import Uniform
 import numpy as np
-import theano
-import theano.tensor as T
 
 from common import dataset_utils
 
-import matplotlib.pyplot as plt
-
 import mainloop_helpers as mlh
-import model_helpers as mh
+import metrics
+import timing
 
 # Main program
 def execute(dataset, n_hidden_u, n_hidden_t_enc, n_hidden_t_dec, n_hidden_s,
@@ -31,7 +24,17 @@ def execute(dataset, n_hidden_u, n_hidden_t_enc, n_hidden_t_dec, n_hidden_s,
             which_fold=0, early_stop_criterion='accuracy',
             save_path='./',
             dataset_path='./',
-            resume=False, exp_name=''):
+            resume=False, exp_name='', batch_size=1024, profile_startup=False,
+            start_time=None):
+    timer = timing.PhaseTimer(start_time)
+
+    # Deferred so that --help does not import Theano
+    import lasagne
+    from lasagne.regularization import apply_penalty, l2
+    import theano
+    import theano.tensor as T
+    import model_helpers as mh
+    timer.lap('imports')
 
     # Prepare embedding information
     if embedding_source is None:
@@ -48,6 +51,7 @@ def execute(dataset, n_hidden_u, n_hidden_t_enc, n_hidden_t_dec, n_hidden_s,
             which_fold=which_fold, keep_labels=keep_labels,
             missing_labels_val=missing_labels_val,
             embedding_input=embedding_input)
+    timer.lap('data load')
 
     if x_unsup is not None:
         n_samples_unsup = x_unsup.shape[1]
@@ -61,7 +65,6 @@ def execute(dataset, n_hidden_u, n_hidden_t_enc, n_hidden_t_dec, n_hidden_s,
     n_targets = y_train.shape[1]
 
     # Set some variables
-    batch_size = 138
     beta = gamma if (gamma == 0) else beta
 
     # Preparing folder to save stuff
@@ -113,13 +116,14 @@ def execute(dataset, n_hidden_u, n_hidden_t_enc, n_hidden_t_dec, n_hidden_s,
 
     # Supervised network
     discrim_net, hidden_rep = mh.build_discrim_net(
-        batch_size, n_feats, input_var_sup, n_hidden_t_enc,
+        None, n_feats, input_var_sup, n_hidden_t_enc,
         n_hidden_s, embeddings[0], disc_nonlinearity, n_targets, batchnorm)
 
     # Reconstruct network
     nets += [mh.build_reconst_net(hidden_rep, embeddings[1] if
                                   len(embeddings) > 1
                                   else None, n_feats, gamma)]
+    timer.lap('graph build')
 
     # Load best model
     with np.load(os.path.join(save_path, 'dietnet_best.npz')) as f:
@@ -128,6 +132,7 @@ def execute(dataset, n_hidden_u, n_hidden_t_enc, n_hidden_t_dec, n_hidden_s,
     lasagne.layers.set_all_param_values(filter(None, nets) +
                                         [discrim_net],
                                         param_values)
+    timer.lap('model load')
 
     print('Building and compiling functions')
 
@@ -193,7 +198,14 @@ def execute(dataset, n_hidden_u, n_hidden_t_enc, n_hidden_t_dec, n_hidden_s,
     val_fn = theano.function(inputs,
                              [prediction_sup_det] + val_outputs,
                              on_unused_input='ignore')
+    timer.lap('compile')
 
+    if profile_startup:
+        minibatch = next(mlh.iterate_minibatches(x_test, y_test, batch_size,
+                                                 shuffle=False))
+        val_fn(*minibatch)
+        timer.lap('first batch')
+        timer.report()
 
     # Finally, launch the test loop.
     print('Starting testing...')
@@ -207,25 +219,11 @@ def execute(dataset, n_hidden_u, n_hidden_t_enc, n_hidden_t_dec, n_hidden_s,
     pred_argmax = pred.argmax(1)
 
     continent_cat = mh.create_1000_genomes_continent_labels()
+    continent_lookup = metrics.group_lookup(continent_cat, n_targets)
 
-    lab_cont = np.zeros(lab.shape)
-    pred_cont = np.zeros(pred_argmax.shape)
-
-    for i,c in enumerate(continent_cat):
-        for el in c:
-            lab_cont[lab == el] = i
-            pred_cont[pred_argmax == el] = i
-
-    cm_e = np.zeros((26, 26))
-    cm_c = np.zeros((5,5))
-
-    for i in range(26):
-        for j in range(26):
-            cm_e[i, j] = ((pred_argmax == i) * (lab == j)).sum()
-
-    for i in range(5):
-        for j in range(5):
-            cm_c[i, j] = ((pred_cont == i) * (lab_cont == j)).sum()
+    cm_e = metrics.confusion_matrix(pred_argmax, lab, n_targets)
+    cm_c = metrics.aggregate_confusion(cm_e, continent_lookup,
+                                       len(continent_cat))
 
     np.savez(os.path.join(save_path, 'cm'+str(which_fold)+'.npz'),
              cm_e=cm_e, cm_c=cm_c)
@@ -335,11 +333,24 @@ def main():
                         type=str,
                         default='dietnet_histo_new2',
                         help='Experiment name that will be concatenated at the beginning of the generated name')
+    parser.add_argument('--batch_size',
+                        type=int,
+                        default=1024,
+                        help='Number of test subjects per minibatch')
+    parser.add_argument('--profile_startup',
+                        type=int,
+                        default=0,
+                        help='Whether to report the time spent importing, ' +
+                             'loading the data, building the model, ' +
+                             'loading its parameters, compiling and ' +
+                             'running the first batch')
 
     args = parser.parse_args()
     print ('Printing args')
     print (args)
 
+    # The imports of the first fold start with the script
+    start_time = START_TIME
     for f in range(5):
 
         execute(args.dataset,
@@ -366,7 +377,11 @@ def main():
                 args.save_path,
                 args.dataset_path,
                 args.resume,
-                args.exp_name)
+                args.exp_name,
+                args.batch_size,
+                args.profile_startup != 0,
+                start_time)
+        start_time = None
 
 
 if __name__ == '__main__':
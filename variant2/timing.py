@@ -0,0 +1,30 @@
+import time
+
+
+class PhaseTimer(object):
+    """
+    Wall-clock durations of the successive phases of a run (imports, data
+    loading, graph building, ...), measured from a start time.
+
+    Parameters
+    ----------
+    start : float
+        Time at which the first phase started, as given by time.time().
+        Defaults to the creation of the timer.
+    """
+    def __init__(self, start=None):
+        self.last = time.time() if start is None else start
+        self.start = self.last
+        self.phases = []
+
+    def lap(self, phase):
+        # Ends the current phase
+        now = time.time()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self):
+        print('Startup time per phase:')
+        for phase, duration in self.phases:
+            print('  {:<16}{:8.3f}s'.format(phase, duration))
+        print('  {:<16}{:8.3f}s'.format('total', self.last - self.start))